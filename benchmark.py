@@ -0,0 +1,375 @@
+# Replays synthetic board pages through the scanning pipeline, without the browser, the board or the network.
+# load_thread_list() -> scan_threads() -> scan_thread() -> scan_content() run as they are on:
+#   a fake browser serving the fixtures, an in-memory SqliteThreadDatabase and a stub download pipeline.
+# Usage: python benchmark.py [--threads 50] [--replies 300] [--cycles 5] [--fetch-mode browser|http]
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import selenium.common.exceptions
+
+
+class Constants:
+    ROOT_DOMAIN = 'https://board.invalid'
+    CAUTION_PATH = '/caution'
+    FIRST_THREAD_ID = 100000
+    PHASES = ('fetch', 'parse', 'analysis', 'db', 'log', 'other')
+    # The new replies of a thread per cycle, drawn per thread
+    REPLY_GROWTH_CHOICES = (0, 0, 0, 1, 3, 10, 30)
+
+    IGNORED_TITLE_PATTERNS = ['홍보', '광고', '구인', '[공지]', 'spam-title']
+    IGNORED_REPLY_PATTERNS = ['홍보합니다', '문의는', '오픈채팅', '수수료', '선입금', '카톡', 'spam-reply']
+    # Plain text of the replies, some of which trigger the specs, contact and ignore rules
+    REPLY_TEXTS = ['오늘 날씨 좋네요', 'ㅋㅋㅋㅋ 그러게요', '65 c 정도', '라인 abcde12 로 연락주세요',
+                   '17o 5x 6o', '문의는 여기로', '저번 글 이어서 씁니다', '이거 맞나요?', 'aaaa 진짜요']
+
+
+# Fixtures
+def build_fixtures(thread_count: int, max_replies: int, seed: int, cycle: int = 0) -> dict:
+    # url: page source, for the thread list and every thread on it, as of the cycle: most threads grow each cycle.
+    rng = random.Random(seed)
+    reply_count_choices = sorted({1, 5, 24, 80, max_replies})
+    pages = {}
+    list_items = []
+    for index in range(thread_count):
+        thread_id = Constants.FIRST_THREAD_ID + index
+        reply_count = min(rng.choice(reply_count_choices) + rng.choice(Constants.REPLY_GROWTH_CHOICES) * cycle,
+                          max_replies)
+        title = 'thread %d %s' % (thread_id, rng.choice(['', '', '', '', Constants.IGNORED_TITLE_PATTERNS[0]]))
+        list_items.append('<a class="thread-list-item" href="%s/%d"><span class="title">%s</span>'
+                          '<span class="count">%d</span></a>' % (Constants.CAUTION_PATH, thread_id, title, reply_count))
+        # The same replies in every cycle, new ones appended
+        thread_rng = random.Random('%d %d' % (seed, thread_id))
+        pages[get_thread_url(thread_id)] = build_thread_page(thread_rng, thread_id, title, reply_count)
+    pages[Constants.ROOT_DOMAIN + Constants.CAUTION_PATH] = wrap_page('<div class="thread-list">%s</div>' %
+                                                                      ''.join(list_items))
+    return pages
+
+
+def build_thread_page(rng: random.Random, thread_id: int, title: str, reply_count: int) -> str:
+    replies = []
+    for reply_no in range(2, reply_count + 1):
+        replies.append('<div class="thread-reply"><div class="reply-info"><span class="reply-offset">#%d</span>'
+                       '<span class="user-id">user%03d</span></div>%s</div>'
+                       % (reply_no, rng.randrange(1000), build_reply_contents(rng, thread_id, reply_no)))
+    return wrap_page('<div class="thread-info"><h3 class="title">%s<span class="thread-no">%d</span></h3>'
+                     '<span class="reply-count">%d</span></div>'
+                     '<div class="thread-first-reply"><span class="user-id">author</span><span class="name">name</span>'
+                     '%s</div>%s'
+                     % (title, thread_id, reply_count, build_reply_contents(rng, thread_id, 1), ''.join(replies)))
+
+
+def build_reply_contents(rng: random.Random, thread_id: int, reply_no: int) -> str:
+    contents = [rng.choice(Constants.REPLY_TEXTS)]
+    if rng.random() < 0.2:
+        contents.append('<br><a class="anchor">&gt;&gt;%d</a>' % max(reply_no - 1, 1))
+    if rng.random() < 0.1:
+        contents.append('<br>' + rng.choice(Constants.IGNORED_REPLY_PATTERNS))
+    if rng.random() < 0.15:
+        contents.append('<br><a class="link" href="https://img.invalid/%d-%d.jpg">img</a>' % (thread_id, reply_no))
+    return '<div class="th-contents">%s</div>' % ''.join(contents)
+
+
+def wrap_page(body: str) -> str:
+    # The page chrome around the contents, which the strained parser skips
+    header = '<div class="header"><span class="user-email">bench@board.invalid</span>%s</div>' % \
+             ''.join('<a class="menu" href="/menu/%d">menu %d</a>' % (i, i) for i in range(40))
+    return '<html><head><title>board</title><script>var x = 1;</script></head><body>%s%s' \
+           '<div class="footer">footer</div></body></html>' % (header, body)
+
+
+def get_thread_url(thread_id: int) -> str:
+    return Constants.ROOT_DOMAIN + Constants.CAUTION_PATH + '/' + str(thread_id)
+
+
+def write_settings(work_dir: str):
+    # The .pv files read on importing the modules
+    settings = {
+        'DRIVER_PATH.pv': 'chromedriver',
+        'ROOT_URL.pv': Constants.ROOT_DOMAIN,
+        'LOGIN_URL.pv': '/login',
+        'LOG_PATH.pv': os.path.join(work_dir, 'logs') + '/',
+        'LOGIN_INFO.pv': 'bench@board.invalid\npassword',
+        'PAUSE.pv': '600\n0.5\n90\n1.1\n1.6',
+        'IGNORED_TITLE_PATTERNS.pv': '\n'.join(Constants.IGNORED_TITLE_PATTERNS),
+        'IGNORED_REPLY_PATTERNS.pv': '\n'.join(Constants.IGNORED_REPLY_PATTERNS),
+        'DL_DESTINATION_PATH.pv': '%s/dl/\n%s/dl-tmp/' % (work_dir, work_dir),
+        'DL_BACKUP_PATH.pv': os.path.join(work_dir, 'backup') + '/',
+        'DUMP_PATH.pv': os.path.join(work_dir, 'dl') + '/',
+        'PASSWORD_CANDIDATES.pv': 'password',
+    }
+    for file_name, content in settings.items():
+        with open(os.path.join(work_dir, file_name), 'w') as f:
+            f.write(content)
+
+
+# Stand-ins
+class FakeElement:
+    def __init__(self, class_name: str):
+        self.class_name = class_name
+
+
+class FakeBrowser:
+    # Serves the fixtures through the part of the WebDriver interface the scanner uses.
+    def __init__(self, pages: dict, served_urls: list):
+        self.pages = pages
+        self.served_urls = served_urls
+        self.current_url = ''
+        self.page_source = ''
+
+    def get(self, url: str):
+        self.served_urls.append(url)
+        self.current_url = url
+        self.page_source = self.pages.get(url, '<html><body><span class="user-email"></span></body></html>')
+
+    def find_element(self, by, value):
+        if value not in self.page_source:
+            raise selenium.common.exceptions.NoSuchElementException('%s not found' % value)
+        return FakeElement(value)
+
+    def find_elements(self, by, value):
+        return [FakeElement(value)] if value in self.page_source else []
+
+    def execute_script(self, script):
+        return 'Mozilla/5.0 (benchmark)'
+
+    def get_cookies(self):
+        return []
+
+    def quit(self):
+        pass
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.headers = {'Content-Type': 'text/html; charset=UTF-8'}
+        self.ok = bool(text)
+        self.status_code = 200 if text else 404
+
+
+class FakeSession:
+    # The requests session of the 'http' fetch mode
+    def __init__(self, pages: dict, served_urls: list):
+        self.pages = pages
+        self.served_urls = served_urls  # Appended from the prefetch workers as well
+
+    def get(self, url: str, **kwargs):
+        self.served_urls.append(url)
+        return FakeResponse(self.pages.get(url, ''))
+
+
+class StubPipeline:
+    # Counts the downloads the scanner submits.
+    def __init__(self):
+        self.submitted_count = 0
+
+    def submit(self, source_url: str, thread_no: int, reply_no: int, prev_pause: float, prev_prev_pause: float):
+        self.submitted_count += 1
+
+    def get_pending_count(self) -> int:
+        return 0
+
+    def close(self):
+        pass
+
+
+# Measurement
+class PhaseTimer:
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.elapsed_sec = dict.fromkeys(Constants.PHASES, 0.0)
+        self.peak_bytes = dict.fromkeys(Constants.PHASES, 0)
+        self.call_counts = dict.fromkeys(Constants.PHASES, 0)
+        self.overall_peak_bytes = 0
+        self.depth = 0  # Only the outermost measured call counts, for the phases not to overlap.
+        # The prefetch workers of the 'http' mode run alongside the main thread: timed apart, without the memory.
+        self.worker_elapsed_sec = dict.fromkeys(Constants.PHASES, 0.0)
+        self.reply_count = 0  # Analyzed on any thread
+        self.lock = threading.Lock()
+
+    def count_replies(self, function):
+        def counted(*args, **kwargs):
+            with self.lock:
+                self.reply_count += 1
+            return function(*args, **kwargs)
+        return counted
+
+    def wrap(self, phase: str, function):
+        def measured(*args, **kwargs):
+            if threading.current_thread() is not threading.main_thread():
+                start_time = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    with self.lock:
+                        self.worker_elapsed_sec[phase] += time.perf_counter() - start_time
+            if self.depth:
+                return function(*args, **kwargs)
+            self.depth += 1
+            if self.trace_memory:
+                traced_bytes, peak_bytes = tracemalloc.get_traced_memory()
+                self.overall_peak_bytes = max(self.overall_peak_bytes, peak_bytes)
+                tracemalloc.reset_peak()
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.elapsed_sec[phase] += time.perf_counter() - start_time
+                self.call_counts[phase] += 1
+                if self.trace_memory:
+                    peak_bytes = tracemalloc.get_traced_memory()[1]
+                    self.peak_bytes[phase] = max(self.peak_bytes[phase], peak_bytes - traced_bytes)
+                    self.overall_peak_bytes = max(self.overall_peak_bytes, peak_bytes)
+                self.depth -= 1
+        return measured
+
+
+def run(args, trace_memory: bool) -> dict:
+    import common
+    import fscr
+    import sqlite
+    import thread_page
+
+    # Built beforehand, not to be timed
+    cycle_pages = [build_fixtures(args.threads, args.replies, args.seed, cycle) for cycle in range(args.cycles)]
+    pages = {}
+    timer = PhaseTimer(trace_memory)
+    # The phases of the main thread add up to the elapsed time. Those of the prefetch workers are reported apart.
+    original_parse_thread_page = thread_page.parse_thread_page
+    original_beautiful_soup = fscr.BeautifulSoup
+    original_log = common.log
+    thread_page.parse_thread_page = timer.wrap('parse', original_parse_thread_page)
+    fscr.BeautifulSoup = timer.wrap('parse', original_beautiful_soup)
+    common.log = timer.wrap('log', original_log)
+    analyzer = fscr.reply_content_analyzer
+    analyzer.analyze = timer.count_replies(timer.wrap('analysis', analyzer.analyze))
+
+    fscr.Constants.FETCH_MODE = args.fetch_mode
+    served_urls = []
+    fscr.browser = FakeBrowser(pages, served_urls)
+    fscr.browser.get = timer.wrap('fetch', fscr.browser.get)
+    fscr.browser_wait = fscr.WebDriverWait(fscr.browser, fscr.Constants.HTML_TIMEOUT)
+    fscr.page_session = FakeSession(pages, served_urls) if args.fetch_mode == 'http' else None
+    fscr.download_pipeline = StubPipeline()
+    fscr.scan_executor = ThreadPoolExecutor(max_workers=fscr.Constants.SCAN_CONCURRENCY)
+    fscr.scan_rate_limiter = fscr.RateLimiter(0)
+    fscr.thread_scheduler = fscr.scheduler.ThreadScheduler()
+    fscr.last_page_source = ''
+    fscr.prev_pause = fscr.prev_prev_pause = 0.0
+
+    # One database across the cycles: every thread is new on the first one, the counts cached on the later ones.
+    fscr.thread_db = sqlite.SqliteThreadDatabase(':memory:')
+    fscr.thread_db.get_reply_counts = timer.wrap('db', fscr.thread_db.get_reply_counts)
+    fscr.thread_db.update_threads = timer.wrap('db', fscr.thread_db.update_threads)
+    cycle_sec = []
+
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for cycle in range(args.cycles):
+                pages.clear()
+                pages.update(cycle_pages[cycle])
+                cycle_start_time = time.perf_counter()
+                fscr.load_thread_list()
+                cycle_sec.append(time.perf_counter() - cycle_start_time)
+            flush_start_time = time.perf_counter()
+            common.flush_logs()
+            timer.elapsed_sec['log'] += time.perf_counter() - flush_start_time
+        elapsed_sec = time.perf_counter() - start_time
+        if trace_memory:
+            timer.overall_peak_bytes = max(timer.overall_peak_bytes, tracemalloc.get_traced_memory()[1])
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        fscr.scan_executor.shutdown()
+        fscr.thread_db.close_connection()
+        thread_page.parse_thread_page = original_parse_thread_page
+        fscr.BeautifulSoup = original_beautiful_soup
+        common.log = original_log
+        del analyzer.analyze
+
+    measured_sec = sum(timer.elapsed_sec[phase] for phase in Constants.PHASES if phase != 'other')
+    timer.elapsed_sec['other'] = max(elapsed_sec - measured_sec, 0.0)
+    page_count = len(served_urls)
+    reply_count = timer.reply_count
+    return {
+        'fetch_mode': args.fetch_mode,
+        'cycles': args.cycles,
+        'elapsed_sec': elapsed_sec,
+        'pages': page_count,
+        'replies': reply_count,
+        'pages_per_sec': page_count / elapsed_sec,
+        'replies_per_sec': reply_count / elapsed_sec,
+        'downloads_submitted': fscr.download_pipeline.submitted_count,
+        'cycle_sec': cycle_sec,
+        'db_cache': fscr.thread_db.get_cache_stats(),
+        'phase_sec': timer.elapsed_sec,
+        'worker_phase_sec': timer.worker_elapsed_sec,
+        'phase_peak_bytes': timer.peak_bytes if trace_memory else None,
+        'peak_bytes': timer.overall_peak_bytes if trace_memory else None,
+    }
+
+
+def print_report(result: dict):
+    print('%d cycles(%s) in %.2f": %d pages(%.1f/s), %d replies(%.1f/s), %d downloads submitted' %
+          (result['cycles'], result['fetch_mode'], result['elapsed_sec'], result['pages'], result['pages_per_sec'],
+           result['replies'], result['replies_per_sec'], result['downloads_submitted']))
+    for phase in Constants.PHASES:
+        line = '  %-8s %8.3f" %5.1f%%' % (phase, result['phase_sec'][phase],
+                                         100 * result['phase_sec'][phase] / result['elapsed_sec'])
+        if result['phase_peak_bytes'] is not None and phase != 'other':
+            line += '  peak %7.2f MB' % (result['phase_peak_bytes'][phase] / 1024 / 1024)
+        if result['worker_phase_sec'][phase]:
+            line += '  (+%.3f" on the workers)' % result['worker_phase_sec'][phase]
+        print(line)
+    later_cycle_sec = result['cycle_sec'][1:]
+    print('  First cycle(cold) %.3f", later cycles %.3f" on average; db cache: %s' %
+          (result['cycle_sec'][0], sum(later_cycle_sec) / len(later_cycle_sec) if later_cycle_sec else 0.0,
+           result['db_cache']))
+    if result['peak_bytes'] is not None:
+        print('  Peak memory: %.2f MB' % (result['peak_bytes'] / 1024 / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the scanning pipeline on synthetic pages.')
+    parser.add_argument('--threads', type=int, default=50, help='threads on the list page')
+    parser.add_argument('--replies', type=int, default=300, help='replies on the longest threads')
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--fetch-mode', choices=('browser', 'http'), default='browser')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON lines')
+    args = parser.parse_args()
+
+    # The modules read their settings from the working directory on import.
+    work_dir = tempfile.mkdtemp(prefix='fscr-benchmark-')
+    write_settings(work_dir)
+    os.chdir(work_dir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    importlib.import_module('fscr')
+
+    results = [run(args, trace_memory=False)]  # Timing, undisturbed by tracemalloc
+    if not args.no_memory:
+        results.append(run(args, trace_memory=True))
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print_report(result)
+    print('Fixtures and logs in %s' % work_dir, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
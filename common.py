@@ -1,4 +1,10 @@
+import atexit
+import gzip
 import os
+import queue
+import re
+import shutil
+import threading
 from datetime import datetime
 
 
@@ -52,33 +58,165 @@ def check_dir_exists(dir_path: str):
         return True  # Already exists.
 
 
-def log(message: str, log_path: str, has_tst: bool = False, has_print: bool = True):
-    dir_path = split_on_last_pattern(log_path, '/')[0]
-    check_dir_exists(dir_path)
+class LogWriter:
+    # Appends the log messages on a background thread, keeping a handle open per log file.
+    def __init__(self, batch_size: int = 256):
+        self.batch_size = batch_size
+        self.__queue = queue.Queue()
+        self.__handles = {}  # log_path: the file opened to append
+        self.__lock = threading.Lock()  # Guards the handles against rename_file() from the other threads
+        self.__thread = None
+
+    def write(self, log_path: str, line: str):
+        if self.__thread is None or not self.__thread.is_alive():
+            self.__start()
+        self.__queue.put((log_path, line))
+
+    def flush(self):
+        # Block until every message queued so far is handed to the OS.
+        if self.__thread is not None and self.__thread.is_alive():
+            self.__queue.join()
+
+    def rename_file(self, log_path: str, new_path: str):
+        # Move the file aside with its pending messages. A new file is opened on the next message.
+        self.flush()
+        with self.__lock:
+            f_append = self.__handles.pop(log_path, None)
+            if f_append:
+                f_append.close()
+            os.replace(log_path, new_path)
+
+    def close(self):
+        self.flush()
+        with self.__lock:
+            for f_append in self.__handles.values():
+                f_append.close()
+            self.__handles.clear()
+
+    def __start(self):
+        with self.__lock:
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__work, name='log-writer', daemon=True)
+                self.__thread.start()
+
+    def __work(self):
+        while True:
+            batch = [self.__queue.get()]
+            try:
+                # Take whatever else has piled up, to write it at once.
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.__queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self.__write_batch(batch)
+            except Exception as batch_exception:
+                print('Error: Cannot write %d log messages(%s).' % (len(batch), batch_exception))
+            finally:
+                # Whatever has happened: flush() must not wait forever.
+                for _ in batch:
+                    self.__queue.task_done()
+
+    def __write_batch(self, batch: list):
+        lines_by_path = {}
+        for log_path, line in batch:
+            lines_by_path.setdefault(log_path, []).append(line)
+        with self.__lock:
+            for log_path, lines in lines_by_path.items():
+                try:
+                    f_append = self.__get_handle(log_path)
+                    f_append.write(''.join(lines))
+                except OSError as write_exception:
+                    print('Error: Cannot write %d lines to %s(%s).' % (len(lines), log_path, write_exception))
+                    continue
+                except Exception:
+                    # A line not writable as it is(not a str, or not encodable): write the others one by one.
+                    for line in lines:
+                        try:
+                            f_append.write(line)
+                        except Exception as line_exception:
+                            print('Error: Cannot write a line to %s(%s): %r' % (log_path, line_exception, line))
+                try:
+                    f_append.flush()
+                except OSError as flush_exception:
+                    print('Error: Cannot flush %s(%s).' % (log_path, flush_exception))
+
+    def __get_handle(self, log_path: str):
+        f_append = self.__handles.get(log_path)
+        if f_append is None:
+            dir_path = split_on_last_pattern(log_path, '/')[0]
+            check_dir_exists(dir_path)
+            f_append = open(log_path, 'a')
+            self.__handles[log_path] = f_append
+        return f_append
+
+
+log_writer = LogWriter()
+atexit.register(log_writer.close)
+
 
-    with open(log_path, 'a') as f_append:
-        if has_tst:
-            message += '\t(%s)' % get_time_str()
-        f_append.write(message + '\n')
+def log(message: str, log_path: str, has_tst: bool = False, has_print: bool = True):
+    if has_tst:
+        message += '\t(%s)' % get_time_str()
+    log_writer.write(log_path, message + '\n')
     if has_print:
         print(message)
 
 
-def trim_logs(log_path: str):
-    lines_threshold = 524288
-    old_lines = 30000
+def flush_logs():
+    log_writer.flush()
 
-    if not os.path.isfile(log_path):
+
+def rotate_log(log_path: str, max_bytes: int = None, backup_count: int = None, compress: bool = None):
+    # Move the log to a dated segment once it has grown over max_bytes, keeping the latest backup_count segments.
+    max_bytes = Constants.LOG_ROTATE_BYTES if max_bytes is None else max_bytes
+    backup_count = Constants.LOG_BACKUP_COUNT if backup_count is None else backup_count
+    compress = Constants.LOG_COMPRESS if compress is None else compress
+
+    log_writer.flush()  # The pending messages count.
+    try:
+        log_size = os.path.getsize(log_path)
+    except FileNotFoundError:
         print('Warning: The file does not exist.')
         return
+    if log_size <= max_bytes:
+        return
 
-    with open(log_path, 'r') as fin:
-        data = fin.read().splitlines(True)
-        print('%d lines in %s.' % (len(data), log_path))
-    if len(data) > lines_threshold:
-        with open(log_path, 'w') as f_write:
-            f_write.writelines(data[old_lines:])
-            print('Trimmed first %d lines.' % old_lines)
+    segment_path = log_path + '.' + datetime.now().strftime('%Y%m%d-%H%M%S')
+    if os.path.exists(segment_path) or os.path.exists(segment_path + '.gz'):
+        return  # Rotated a moment ago.
+    log_writer.rename_file(log_path, segment_path)
+    print('%.1f MB of %s moved to %s.' % (log_size / 1024 / 1024, log_path, segment_path))
+
+    if compress:
+        threading.Thread(target=__compress_segment, args=(segment_path,), name='log-compressor', daemon=True).start()
+    __remove_old_segments(log_path, backup_count)
+
+
+def __compress_segment(segment_path: str):
+    try:
+        with open(segment_path, 'rb') as f_in, gzip.open(segment_path + '.gz.part', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.replace(segment_path + '.gz.part', segment_path + '.gz')
+        os.remove(segment_path)
+    except OSError as compress_exception:
+        print('Error: Cannot compress %s(%s).' % (segment_path, compress_exception))
+
+
+def __remove_old_segments(log_path: str, backup_count: int):
+    dir_path, file_name = os.path.split(log_path)
+    segment_pattern = re.compile(re.escape(file_name) + r'\.(\d{8}-\d{6})(\.gz)?$')
+    segments = {}  # Timestamp: the segment files, either or both of the plain and the compressed
+    for name in os.listdir(dir_path or '.'):
+        segment_match = segment_pattern.match(name)
+        if segment_match:
+            segments.setdefault(segment_match.group(1), []).append(os.path.join(dir_path, name))
+    for timestamp in sorted(segments, reverse=True)[backup_count:]:
+        for segment_path in segments[timestamp]:
+            try:
+                os.remove(segment_path)
+            except FileNotFoundError:
+                pass  # Replaced by its compressed file meanwhile.
 
 
 class Constants:
@@ -87,6 +225,10 @@ class Constants:
     LOGIN_PATH = read_from_file('LOGIN_URL.pv')
     LOG_PATH = read_from_file('LOG_PATH.pv')
     LOG_FILE = 'log-fs.pv'
+    # Rotation of the log files
+    LOG_ROTATE_BYTES = 64 * 1024 * 1024
+    LOG_BACKUP_COUNT = 8  # The dated segments kept per log file
+    LOG_COMPRESS = True  # gzip the segments in the background
     CAUTION_PATH = '/caution'
 
     # BeautifulSoup parsing format
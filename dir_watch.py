@@ -0,0 +1,93 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import time
+
+
+class Constants:
+    # inotify(7)
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    # The file names changing: Chrome renames the .crdownload file to the final name when the download finishes.
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT_BUFFER_SIZE = 4096
+
+    # Without inotify, poll from the shortest interval, backing off while nothing changes.
+    MIN_POLL_INTERVAL_SEC = 0.05
+    MAX_POLL_INTERVAL_SEC = 1.0
+
+
+def __load_inotify_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+# None where inotify is unavailable
+inotify_libc = __load_inotify_libc()
+
+
+class DirectoryWatcher:
+    # Wakes up as soon as a file of the directory is created, renamed, closed or deleted.
+    # Falls back to an adaptive poll where inotify is unavailable.
+    def __init__(self, dir_path: str):
+        self.dir_path = dir_path
+        self.fd = None
+        self.poll_interval = Constants.MIN_POLL_INTERVAL_SEC
+        if inotify_libc is not None:
+            fd = inotify_libc.inotify_init1(Constants.IN_NONBLOCK | Constants.IN_CLOEXEC)
+            if fd >= 0:
+                if inotify_libc.inotify_add_watch(fd, os.fsencode(dir_path), Constants.WATCH_MASK) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+
+    def is_event_driven(self) -> bool:
+        return self.fd is not None
+
+    def wait(self, timeout: float) -> bool:
+        # Block up to timeout seconds. True if the directory has changed(always True when polling).
+        if self.fd is None:
+            time.sleep(min(self.poll_interval, timeout))
+            return True
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, Constants.EVENT_BUFFER_SIZE):  # Drain: the caller rescans the directory anyway.
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def report_progress(self, has_changed: bool):
+        # Polling only: back to the shortest interval on a change, otherwise wait longer.
+        if has_changed:
+            self.poll_interval = Constants.MIN_POLL_INTERVAL_SEC
+        else:
+            self.poll_interval = min(self.poll_interval * 2, Constants.MAX_POLL_INTERVAL_SEC)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
@@ -1,5 +1,4 @@
 import common
-from glob import glob
 from shutil import copyfile
 import os
 import traceback
@@ -8,12 +7,22 @@ import selenium.common.exceptions
 from selenium import webdriver
 from bs4 import BeautifulSoup
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import urlparse
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions
 from selenium.webdriver.support.wait import WebDriverWait
 from PIL import Image
 import time
+import hashlib
+import queue
+import threading
+import json
+import dir_watch
+import metrics
+from contextlib import contextmanager
+from collections import namedtuple, OrderedDict
 
 
 class Constants:
@@ -23,25 +32,538 @@ class Constants:
     DUMP_PATH = common.read_from_file('DUMP_PATH.pv')
     PASSWORDS = common.build_tuple('PASSWORD_CANDIDATES.pv')
 
+    # The shared HTTP client
+    HTTP_TIMEOUT = (10, 60)  # (connect, read) in seconds
+    HTTP_POOL_SIZE = 8  # Kept-alive connections per host
+    HTTP_CONNECT_RETRIES = 3
+    HTTP_PROXY = None  # e.g. 'http://127.0.0.1:8080' to send the links to standin_server.py
+
+    # Writing the downloaded files
+    DL_CHUNK_SIZE = 1024 * 1024
+    DL_WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+    DL_PREALLOCATE = True  # If Content-Length is known
+    DL_FSYNC = True  # Once, when the file is complete
+    DL_PART_EXTENSION = '.part'  # Renamed to the final name once complete
+    DL_MAX_ATTEMPTS = 3  # The later attempts resume with a Range request.
+    DL_PART_STATE_INTERVAL = 16 * 1024 * 1024  # How often the progress of a .part file is recorded
+    DL_PART_EXPIRY_SEC = 3 * 24 * 3600  # A .part file untouched this long is not going to be resumed.
+
+    # The cache of the resolved links: {outcome: seconds to keep}
+    DL_RESOLUTION_TTL_SEC = {
+        'content-type': 24 * 3600,  # The content type of a url
+        'resolved': 24 * 3600,  # The file url found on a hosting page
+        'deleted': 30 * 24 * 3600,
+        'page-not-found': 7 * 24 * 3600,
+    }
+    DL_RESOLUTION_CACHE_SIZE = 16384
+    DL_RESOLUTION_CACHE_PATH = None  # e.g. 'resolution-cache.pv' to keep the cache across restarts
+
+    # The pool of the download browsers
+    DL_BROWSER_POOL_SIZE = 2
+    DL_BROWSER_MAX_USES = 50  # A browser is restarted after this many downloads.
+
+    # The background download pipeline
+    DL_WORKER_COUNT = 2
+    DL_QUEUE_SIZE = 64  # Submitting blocks while this many jobs are pending.
+    DL_SHUTDOWN_TIMEOUT = 600
+
+    # The browser downloads
+    DL_BROWSER_PART_EXTENSION = '.crdownload'
+    DL_PROGRESS_INTERVAL_SEC = 1.0  # Between the progress reports, also the longest wait for a change
+    DL_STALL_TIMEOUT_SEC = 24  # Without any file growing
+
+    # The content-addressed store: one copy of each file under DL_DESTINATION_PATH/DL_STORE_DIR_NAME, hardlinked to
+    # the names. The urls fetched before are linked again without the network.
+    DL_STORE_ENABLED = True
+    DL_STORE_DIR_NAME = '.store'
+    DL_STORE_INDEX_FILE = 'index.json'  # In the store directory
+    DL_STORE_HASH = 'sha256'
+    DL_STORE_MAX_URLS = 262144  # The least recently used urls forgotten beyond this
+
+
+def __build_http_session() -> requests.Session:
+    # Only the connection errors are retried: a request that has reached the host is not repeated, nor one failed
+    # otherwise, e.g. on SSL.
+    retry = Retry(total=None, connect=Constants.HTTP_CONNECT_RETRIES, read=0, status=0, other=0, redirect=10,
+                  backoff_factor=0.5)
+    adapter = HTTPAdapter(pool_connections=Constants.HTTP_POOL_SIZE, pool_maxsize=Constants.HTTP_POOL_SIZE,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if Constants.HTTP_PROXY:
+        session.proxies = {'http': Constants.HTTP_PROXY, 'https': Constants.HTTP_PROXY}
+    return session
+
+
+# Shared by every request of the downloader to reuse the connections.
+http_session = __build_http_session()
+
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault('timeout', Constants.HTTP_TIMEOUT)
+    return http_session.get(url, **kwargs)
+
+
+class ResolutionCache:
+    # Remembers what each link resolved to, including the failures, for the period of its outcome.
+    def __init__(self, path: str = Constants.DL_RESOLUTION_CACHE_PATH,
+                 max_size: int = Constants.DL_RESOLUTION_CACHE_SIZE, ttl_sec: dict = None):
+        self.path = path
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec if ttl_sec else Constants.DL_RESOLUTION_TTL_SEC
+        self.entries = OrderedDict()  # {'kind url': (expires_at, value)}, the least recently used first
+        self.lock = threading.Lock()  # Shared by the download workers
+        self.save_lock = threading.Lock()  # One writer of the file at a time
+        self.unsaved_count = 0
+        self.hits = 0
+        self.misses = 0
+        if self.path:
+            self.load()
+
+    def get(self, kind: str, url: str):
+        key = '%s %s' % (kind, url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self.entries[key]  # Expired
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, kind: str, url: str, outcome: str, value: list):
+        key = '%s %s' % (kind, url)
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl_sec[outcome], value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.unsaved_count += 1
+            is_save_due = self.path and self.unsaved_count >= 64
+        if is_save_due:
+            self.save()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                now = time.time()
+                for key, expires_at, value in json.load(f):
+                    if expires_at > now:
+                        self.entries[key] = (expires_at, value)
+        except Exception as load_exception:
+            log('Error: Cannot load the resolution cache.(%s)' % load_exception)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.save_lock:  # Taken first: the entries copied last are written last.
+            with self.lock:
+                entries = [[key, expires_at, value] for key, (expires_at, value) in self.entries.items()]
+                self.unsaved_count = 0
+            try:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.path)  # Never leave a half-written cache.
+            except Exception as save_exception:
+                log('Error: Cannot save the resolution cache.(%s)' % save_exception)
+
+    def get_stats(self) -> str:
+        return '%d hits, %d misses on %d links' % (self.hits, self.misses, len(self.entries))
+
+
+resolution_cache = ResolutionCache()
+
+
+class ContentStore:
+    # Keeps a single copy of each content, by its hash, and a hardlink to it for every name.
+    # index.json holds {'urls': [[url, hash, extension], ...], 'blobs': {hash: size}} as of the last save(), the changes
+    # since appended to index.json.log line by line: a download costs a line, the whole index written once a session.
+    def __init__(self, dir_path: str, max_url_count: int = Constants.DL_STORE_MAX_URLS):
+        self.dir_path = dir_path
+        self.index_path = os.path.join(dir_path, Constants.DL_STORE_INDEX_FILE)
+        self.journal_path = self.index_path + '.log'
+        self.max_url_count = max_url_count
+        self.urls = OrderedDict()  # {url: (hash, extension of the file name)}, the least recently used first
+        self.blobs = {}  # {hash: [size, the names linked]}
+        self.lock = threading.Lock()  # Shared by the download workers
+        self.fetched_bytes = 0  # This session: written by fetching
+        self.skipped_bytes = 0  # This session: linked without fetching, the url known
+        self.is_loaded = False
+
+    def get_blob_path(self, digest: str) -> str:
+        return os.path.join(self.dir_path, digest[:2], digest)
+
+    def get_known_extension(self, url: str):
+        # The extension of the file fetched from the url before, None if not fetched
+        with self.lock:
+            self.__load()
+            entry = self.urls.get(url)
+            return entry[1] if entry else None
+
+    def link_known(self, url: str, file_path: str):
+        # The size if the url has been fetched before and linked to file_path again, otherwise None.
+        with self.lock:
+            self.__load()
+            entry = self.urls.get(url)
+            if entry is None:
+                return None
+            digest = entry[0]
+            blob_path = self.get_blob_path(digest)
+            if digest not in self.blobs or not os.path.isfile(blob_path):
+                del self.urls[url]  # Pruned, or removed by hand: fetch it again.
+                return None
+            self.urls.move_to_end(url)
+            self.__link(blob_path, file_path)
+            blob = self.blobs[digest]
+            blob[1] += 1
+            self.skipped_bytes += blob[0]
+            return blob[0]
+
+    def add(self, url: str, part_path: str, digest: str, file_path: str) -> bool:
+        # Move the complete part_path into the store and link it to file_path. True if the content was there already.
+        blob_path = self.get_blob_path(digest)
+        size = os.path.getsize(part_path)
+        extension = os.path.splitext(file_path)[1][1:]
+        with self.lock:
+            self.__load()
+            is_duplicate = os.path.isfile(blob_path)
+            if is_duplicate:
+                os.remove(part_path)
+            else:
+                common.check_dir_exists(os.path.dirname(blob_path))
+                os.replace(part_path, blob_path)
+            self.__link(blob_path, file_path)
+            blob = self.blobs.setdefault(digest, [size, 0])
+            blob[1] += 1
+            self.__remember_url(url, digest, extension)
+            self.fetched_bytes += size
+            try:
+                with open(self.journal_path, 'a') as f:
+                    f.write(json.dumps([url, digest, size, extension]) + '\n')
+            except OSError as journal_exception:
+                log('Error: Cannot record %s in the content store index.(%s)' % (url, journal_exception))
+        return is_duplicate
+
+    def prune(self) -> int:
+        # Recount the names of each content by its links, removing the ones no longer linked from the destination.
+        # Returns the bytes freed.
+        freed_size = 0
+        with self.lock:
+            if not self.is_loaded:
+                return 0
+            for digest, blob in list(self.blobs.items()):
+                blob_path = self.get_blob_path(digest)
+                try:
+                    link_count = os.stat(blob_path).st_nlink
+                    if link_count <= 1:  # The store's own: every name deleted, renamed over or converted
+                        os.remove(blob_path)
+                        freed_size += blob[0]
+                except FileNotFoundError:
+                    link_count = 0
+                if link_count <= 1:
+                    del self.blobs[digest]
+                else:
+                    blob[1] = link_count - 1
+            for url in [url for url, (digest, _) in self.urls.items() if digest not in self.blobs]:
+                del self.urls[url]
+        return freed_size
+
+    def save(self):
+        # Write the whole index, emptying the journal.
+        with self.lock:
+            if not self.is_loaded:
+                return
+            index = {'urls': [[url, digest, extension] for url, (digest, extension) in self.urls.items()],
+                     'blobs': {digest: blob[0] for digest, blob in self.blobs.items()}}
+            try:
+                tmp_path = self.index_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(index, f)
+                os.replace(tmp_path, self.index_path)  # Never leave a half-written index.
+                open(self.journal_path, 'w').close()
+            except Exception as save_exception:
+                log('Error: Cannot save the content store index.(%s)' % save_exception)
+
+    def get_stats(self) -> str:
+        with self.lock:
+            stored_bytes = sum(size for size, _ in self.blobs.values())
+            linked_bytes = sum(size * name_count for size, name_count in self.blobs.values())
+            return '%d files as %d(%.1f/%.1f MB, dedup ratio %.2f), %.1f MB fetched, %.1f MB known this session' % \
+                (sum(name_count for _, name_count in self.blobs.values()), len(self.blobs),
+                 linked_bytes / 1000000, stored_bytes / 1000000, linked_bytes / stored_bytes if stored_bytes else 1.0,
+                 self.fetched_bytes / 1000000, self.skipped_bytes / 1000000)
+
+    def __load(self):
+        # On the first use, not to touch the destination at import.
+        if self.is_loaded:
+            return
+        self.is_loaded = True
+        common.check_dir_exists(self.dir_path)
+        try:
+            if os.path.isfile(self.index_path):
+                with open(self.index_path, 'r') as f:
+                    index = json.load(f)
+                for url_entry in index['urls']:  # Without the extension if saved by an older version
+                    self.__remember_url(url_entry[0], url_entry[1], url_entry[2] if len(url_entry) > 2 else None)
+                self.blobs = {digest: [size, 0] for digest, size in index['blobs'].items()}
+            if os.path.isfile(self.journal_path):
+                with open(self.journal_path, 'r') as f:
+                    for line in f:
+                        try:
+                            journal_entry = json.loads(line)
+                            url, digest, size = journal_entry[:3]
+                        except ValueError:
+                            continue  # Cut off by a crash
+                        self.__remember_url(url, digest, journal_entry[3] if len(journal_entry) > 3 else None)
+                        self.blobs.setdefault(digest, [size, 0])
+        except Exception as load_exception:
+            log('Error: Cannot load the content store index.(%s)' % load_exception)
+        # The names as linked now
+        for digest, blob in self.blobs.items():
+            try:
+                blob[1] = max(os.stat(self.get_blob_path(digest)).st_nlink - 1, 0)
+            except FileNotFoundError:
+                pass  # Dropped on prune().
+
+    def __remember_url(self, url: str, digest: str, extension: str):
+        self.urls[url] = (digest, extension)
+        self.urls.move_to_end(url)
+        while len(self.urls) > self.max_url_count:
+            self.urls.popitem(last=False)
+
+    @staticmethod
+    def __link(blob_path: str, file_path: str):
+        # Replace file_path atomically. A copy where the file system has no hardlinks.
+        tmp_path = file_path + '.link'
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(blob_path, tmp_path)
+        except OSError:
+            copyfile(blob_path, tmp_path)
+        os.replace(tmp_path, file_path)
+
+
+content_store = ContentStore(os.path.join(Constants.DL_DESTINATION_PATH, Constants.DL_STORE_DIR_NAME))
+
+
+class BackupIndex:
+    # {imgdb index: file name} of the backup directory, e.g. {'19092307': '19092307-a.jpg'}
+    # Read once, and again only if the modification time of the directory has changed.
+    def __init__(self, dir_path: str = Constants.DL_BACKUP_PATH):
+        self.dir_path = dir_path
+        self.file_names = {}
+        self.dir_mtime_ns = None
+        self.lock = threading.Lock()  # Shared by the download workers
+
+    def take(self, int_index: str):
+        # The file name of the index, removed from the index as the file is about to be moved out.
+        with self.lock:
+            self.__refresh()
+            return self.file_names.pop(int_index, None)
+
+    def put_back(self, int_index: str, file_name: str):
+        # The file taken has not been moved out after all.
+        with self.lock:
+            self.file_names.setdefault(int_index, file_name)
+
+    def acknowledge_change(self):
+        # Only after moving a file out successfully: take the new modification time as the indexed state.
+        with self.lock:
+            try:
+                self.dir_mtime_ns = os.stat(self.dir_path).st_mtime_ns
+            except FileNotFoundError:
+                self.dir_mtime_ns = None
+
+    def __refresh(self):
+        try:
+            dir_mtime_ns = os.stat(self.dir_path).st_mtime_ns
+        except FileNotFoundError:
+            self.file_names.clear()
+            self.dir_mtime_ns = None
+            return
+        if dir_mtime_ns == self.dir_mtime_ns:
+            return
+        file_names = {}
+        for file_name in os.listdir(self.dir_path):
+            if '-' in file_name:
+                file_names.setdefault(file_name.split('-')[0], file_name)
+        self.file_names = file_names
+        self.dir_mtime_ns = dir_mtime_ns
+        print('%d files indexed in %s.' % (len(file_names), self.dir_path))
+
+
+backup_index = BackupIndex()
+
+
+class PathLocks:
+    # A lock per path, kept only while it is held or waited for
+    def __init__(self):
+        self.locks = {}  # path: [lock, the jobs holding or waiting for it]
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, path: str):
+        with self.lock:
+            entry = self.locks.setdefault(path, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[path]
+
+
+destination_locks = PathLocks()
+
+
+DownloadJob = namedtuple('DownloadJob', ['source_url', 'thread_no', 'reply_no', 'prev_pause', 'prev_prev_pause'])
+
+
+class DownloadPipeline:
+    # Runs the downloads on background workers, so that the scanning does not wait for the file hosts.
+    def __init__(self, worker_count: int = Constants.DL_WORKER_COUNT, queue_size: int = Constants.DL_QUEUE_SIZE):
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.workers = [threading.Thread(target=self.__work, name='downloader-%d' % n, daemon=True)
+                        for n in range(worker_count)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, source_url: str, thread_no: int, reply_no: int, prev_pause: float, prev_prev_pause: float):
+        # Blocks while the queue is full: the scanning slows down to the pace of the downloads.
+        if self.jobs.full():
+            log('Warning: %d downloads pending. Waiting for a free slot.' % self.jobs.qsize(), has_tst=True)
+        self.jobs.put(DownloadJob(source_url, thread_no, reply_no, prev_pause, prev_prev_pause))
+
+    def get_pending_count(self) -> int:
+        return self.jobs.qsize()
+
+    def close(self, timeout: float = Constants.DL_SHUTDOWN_TIMEOUT):
+        # Let the workers finish the pending jobs, then stop them.
+        pending_count = self.jobs.qsize()
+        if pending_count:
+            log('Finishing %d pending downloads.' % pending_count, has_tst=True)
+        for _ in self.workers:
+            self.jobs.put(None)  # A worker stops on None.
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+            if worker.is_alive():
+                log('Warning: %s has not finished in %d".' % (worker.name, timeout), has_tst=True)
+
+    def __work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                download(*job)
+            except Exception as worker_exception:  # download() handles its own exceptions. Keep the worker alive.
+                log('Error: Download worker failed.(%s)' % worker_exception, has_tst=True)
+            finally:
+                self.jobs.task_done()
+
 
 def log(message: str, file_name: str = common.Constants.LOG_FILE, has_tst: bool = False):
     common.log(message, log_path=common.Constants.LOG_PATH + file_name, has_tst=has_tst)
 
 
-def initiate_browser():
+def initiate_browser(download_dir: str = Constants.DL_TMP_PATH):
     # A Chrome web driver with headless option
     # service = Service(common.Constants.DRIVER_PATH)
     options = webdriver.ChromeOptions()
     options.add_experimental_option("prefs", {
-        "download.default_directory": Constants.DL_TMP_PATH,
+        "download.default_directory": os.path.abspath(download_dir),
         "download.prompt_for_download": False
     })
     options.add_argument('headless')
     # options.add_argument('disable-gpu')
+    if Constants.HTTP_PROXY:
+        options.add_argument('--proxy-server=%s' % Constants.HTTP_PROXY)
     driver = webdriver.Chrome(executable_path=common.Constants.DRIVER_PATH, options=options)
     return driver
 
 
+class BrowserPool:
+    # Started download browsers, leased one at a time. Each downloads into its own directory under DL_TMP_PATH.
+    def __init__(self, size: int = Constants.DL_BROWSER_POOL_SIZE, max_uses: int = Constants.DL_BROWSER_MAX_USES):
+        self.max_uses = max_uses
+        self.slots = [{'dir': Constants.DL_TMP_PATH + 'slot-%d/' % n, 'browser': None, 'uses': 0} for n in range(size)]
+        self.idle_slots = queue.Queue()
+        for slot in self.slots:
+            self.idle_slots.put(slot)
+
+    def start(self):
+        # Start the browsers in advance, so that a download does not wait for the startup.
+        for slot in self.slots:
+            if slot['browser'] is None:
+                self.__start_browser(slot)
+
+    @contextmanager
+    def lease(self):
+        # (browser, download directory), blocking until a browser is free
+        slot = self.idle_slots.get()
+        try:
+            if slot['browser'] is None:
+                self.__start_browser(slot)
+            slot['uses'] += 1
+            yield slot['browser'], slot['dir']
+        finally:
+            self.__reset(slot)
+            self.idle_slots.put(slot)
+
+    def recycle(self, browser: webdriver.Chrome):
+        # Quit a leased browser that may still be downloading, so that it stops writing into its directory.
+        # A new one is started on the next lease.
+        for slot in self.slots:
+            if slot['browser'] is browser:
+                self.__quit_browser(slot)
+
+    def close(self):
+        for slot in self.slots:
+            self.__quit_browser(slot)
+
+    def __start_browser(self, slot: dict):
+        common.check_dir_exists(slot['dir'])
+        slot['browser'] = initiate_browser(slot['dir'])
+        slot['uses'] = 0
+
+    def __reset(self, slot: dict):
+        if slot['browser'] is None:
+            return
+        if slot['uses'] >= self.max_uses:
+            self.__quit_browser(slot)
+            return
+        try:
+            # delete_all_cookies() would clear only those of the current page's domain.
+            slot['browser'].execute_cdp_cmd('Network.clearBrowserCookies', {})
+            slot['browser'].get('about:blank')
+        except Exception as reset_exception:  # Crashed: start a new one on the next lease.
+            log('Warning: Restarting a download browser.(%s)' % reset_exception)
+            self.__quit_browser(slot)
+
+    @staticmethod
+    def __quit_browser(slot: dict):
+        if slot['browser'] is not None:
+            try:
+                slot['browser'].quit()
+            except Exception as quit_exception:
+                print('Error: Cannot quit the browser(%s).' % quit_exception)
+            slot['browser'] = None
+
+
+browser_pool = BrowserPool()
+
+
 def __get_url_index(url: str) -> ():
     url_index = []  # for example, url_index = [3, 5, 1, 9] (a list of int)
     str_index = common.split_on_last_pattern(url, '/')[-1]  # 'a3Fx' from 'https://domain.com/a3Fx'
@@ -78,87 +600,307 @@ def __convert_webp_to_png(stored_dir, filename):
     os.remove(stored_path)
 
 
-def __exist_tmp_download(dir_path: str) -> bool:
-    tmp_extension = 'crdownload'
-    for file_name in os.listdir(dir_path):
-        if tmp_extension in file_name:
-            return True
-    else:
-        return False
-
-
-def wait_finish_downloading(temp_dir_path: str, timeout: int):
-    seconds = 0
-    check_interval = 2
-
-    last_size = 0
-    consecutive_stalling = 0
-
-    while seconds <= timeout:
-        current_size = sum(os.path.getsize(f) for f in glob(temp_dir_path + '*') if os.path.isfile(f))
-        if current_size == last_size:
-            if current_size > 0 and not __exist_tmp_download(temp_dir_path):
-                # Size not increasing because the download has been finished.
-                return True
-            else:  # size = 0 or .crdownload file exists.
-                if consecutive_stalling < 12:
-                    print('Downloading stalled. (%d/%d)' % (seconds, timeout))
-                    consecutive_stalling += 1
-                else:
-                    log('Warning: Download not progressing.(%s present, size of %d bytes.)'
-                        % (os.listdir(temp_dir_path), current_size))
-                    return False
-        # Report
-        if current_size != last_size:
-            print('%.1f -> %.1f MB' % (last_size / 1000000, current_size / 1000000))
-        # Wait
-        time.sleep(check_interval)
-        seconds += check_interval
-        if last_size != current_size:
-            last_size = current_size
-    log('Download timeout reached.')
-    return False  # Timeout
+def __get_file_sizes(dir_path: str) -> dict:
+    # file name: size, in a single listing
+    file_sizes = {}
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    file_sizes[entry.name] = entry.stat().st_size
+            except FileNotFoundError:
+                pass  # Renamed meanwhile. Listed on the next scan.
+    return file_sizes
+
+
+def wait_finish_downloading(temp_dir_path: str, timeout: int) -> ():
+    # Wait for the browser to finish, waking up as soon as the .crdownload file gets its final name.
+    # Returns (is_finished, downloaded bytes, elapsed seconds).
+    start_time = time.monotonic()
+    last_progress_time = last_report_time = start_time
+    last_sizes = reported_sizes = {}
+
+    with dir_watch.DirectoryWatcher(temp_dir_path) as watcher:
+        while True:
+            now = time.monotonic()
+            elapsed_sec = max(now - start_time, 0.001)
+            file_sizes = __get_file_sizes(temp_dir_path)
+            current_size = sum(file_sizes.values())
+            is_downloading = any(name.endswith(Constants.DL_BROWSER_PART_EXTENSION) for name in file_sizes)
+            if current_size > 0 and not is_downloading:
+                print('%.1f MB downloaded in %.1f" (%.2f MB/s)' %
+                      (current_size / 1000000, elapsed_sec, current_size / 1000000 / elapsed_sec))
+                return True, current_size, elapsed_sec
+
+            has_changed = file_sizes != last_sizes
+            if has_changed:
+                last_progress_time = now
+                last_sizes = file_sizes
+            # Report the progress of each file.
+            if has_changed and now - last_report_time >= Constants.DL_PROGRESS_INTERVAL_SEC:
+                report_interval = now - last_report_time
+                for file_name, file_size in file_sizes.items():
+                    print('%s: %.1f MB (%.2f MB/s)' % (file_name, file_size / 1000000,
+                          max(file_size - reported_sizes.get(file_name, 0), 0) / 1000000 / report_interval))
+                last_report_time = now
+                reported_sizes = file_sizes
+
+            if now - last_progress_time > Constants.DL_STALL_TIMEOUT_SEC:
+                log('Warning: Download not progressing.(%s present, size of %d bytes.)'
+                    % (list(file_sizes), current_size))
+                return False, current_size, elapsed_sec
+            if elapsed_sec > timeout:
+                log('Download timeout reached.')
+                return False, current_size, elapsed_sec
+
+            watcher.report_progress(has_changed)
+            watcher.wait(min(Constants.DL_PROGRESS_INTERVAL_SEC, timeout - elapsed_sec))
 
 
 def download(source_url: str, thread_no: int, reply_no: int, prev_pause: float, prev_prev_pause: float):
     thread_url = common.get_thread_url(thread_no)
     common.check_dir_exists(Constants.DL_DESTINATION_PATH)
+    host = urlparse(source_url).netloc.replace('www.', '')
+    outcome = 'other'  # Restored, downloaded on a browser, or not downloadable
+    start_time = time.monotonic()
 
     # Set the download target.
     try:
-        target = __extract_download_target(source_url, thread_no, reply_no, prev_pause, prev_prev_pause)
+        # A file fetched before is linked again under the name of a direct link, its content type not probed.
+        known_extension = content_store.get_known_extension(source_url) if Constants.DL_STORE_ENABLED else None
+        if known_extension:
+            target = source_url, __format_direct_file_name(thread_no, reply_no, known_extension)
+        else:
+            target = __extract_download_target(source_url, thread_no, reply_no, prev_pause, prev_prev_pause)
         if target is not None:  # If None, a respective error message has been issued in __extract method.
             file_url, file_name = target
-            session = requests.get(file_url, stream=True)
             file_path = os.path.join(Constants.DL_DESTINATION_PATH, file_name)
-            with open(file_path, 'wb') as f:
-                for chunk in session.iter_content(chunk_size=1024 * 8):
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
-                        os.fsync(f.fileno())
-            log("%s" % (Constants.DUMP_PATH + file_name), has_tst=True)
-            log('[ V ] <- %.f" \t<- %.f"\t: %s #%d  \t->  \t%s' %
-                (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
-                file_name=Constants.DL_LOG_FILE)
+            # One job at a time on a file: the same link twice in a reply would share the .part file.
+            with destination_locks.hold(file_path):
+                # A webp file is converted to png right after: its stored copy would outlive it.
+                is_stored = Constants.DL_STORE_ENABLED and not file_name.endswith('.webp')
+                known_size = content_store.link_known(file_url, file_path) if is_stored else None
+                if known_size is not None:
+                    outcome = 'known'
+                    metrics.inc('fscr_download_dedup_bytes_total', known_size, host=host, source='url')
+                    transfer_str = '%.1f MB, known' % (known_size / 1000000)
+                else:
+                    download_start_time = time.monotonic()
+                    file_size, fetched_size, is_duplicate = __fetch_to_file(file_url, file_path, is_stored)
+                    elapsed_sec = max(time.monotonic() - download_start_time, 0.001)
+                    outcome = 'fetched'
+                    metrics.inc('fscr_download_bytes_total', fetched_size, host=host)
+                    transfer_str = '%.1f MB, %.2f MB/s' % (file_size / 1000000, fetched_size / 1000000 / elapsed_sec)
+                    if is_duplicate:
+                        metrics.inc('fscr_download_dedup_bytes_total', file_size, host=host, source='content')
+                        transfer_str += ', duplicate'
+                log("%s" % (Constants.DUMP_PATH + file_name), has_tst=True)
+                log('[ V ] <- %.f" \t<- %.f"\t: %s #%d  \t->  \t%s\t(%s)' %
+                    (prev_pause, prev_prev_pause, thread_url, reply_no, source_url, transfer_str),
+                    file_name=Constants.DL_LOG_FILE)
 
-            # Convert a webp file.
-            if file_name.endswith('.webp'):
-                __convert_webp_to_png(Constants.DL_DESTINATION_PATH, file_name)
+                # Convert a webp file.
+                if file_name.endswith('.webp'):
+                    __convert_webp_to_png(Constants.DL_DESTINATION_PATH, file_name)
 
     except Exception as download_exception:
+        outcome = 'failed'
         log("Error: Download failed.(%s)" % download_exception, has_tst=True)
         log('Download failure traceback\n\n' + traceback.format_exc(), file_name='exception-dl.pv', has_tst=True)
         print(traceback.format_exc())
+        common.flush_logs()
+    finally:
+        metrics.observe('fscr_download_seconds', time.monotonic() - start_time, host=host, outcome=outcome)
+
+
+def __fetch_to_file(file_url: str, file_path: str, is_stored: bool) -> ():
+    # Returns (file size, bytes fetched, whether the content was in the store already).
+    # Into the content store if is_stored, otherwise only to file_path.
+    # An interrupted transfer is resumed from where it stopped.
+    fetched_size = 0
+    for attempt in range(1, Constants.DL_MAX_ATTEMPTS + 1):
+        try:
+            file_size, attempt_fetched_size, is_duplicate = __fetch_once(file_url, file_path, is_stored)
+            return file_size, fetched_size + attempt_fetched_size, is_duplicate
+        except __PartialDownloadError as partial_error:
+            fetched_size += partial_error.fetched_size
+            if attempt == Constants.DL_MAX_ATTEMPTS:
+                raise partial_error.cause
+            log('Warning: Download interrupted at %.1f MB(%d/%d), resuming.(%s)' %
+                (partial_error.received / 1000000, attempt, Constants.DL_MAX_ATTEMPTS, partial_error.cause))
+
+
+class __PartialDownloadError(Exception):
+    def __init__(self, cause: Exception, received: int, fetched_size: int):
+        super().__init__(str(cause))
+        self.cause = cause
+        self.received = received  # The bytes kept in the .part file
+        self.fetched_size = fetched_size  # The bytes fetched by the failed attempt
+
+
+def __fetch_once(file_url: str, file_path: str, is_stored: bool) -> ():
+    part_path = file_path + Constants.DL_PART_EXTENSION
+    state_path = part_path + '.json'
+    part_state = __load_part_state(state_path, part_path, file_url)
+
+    # The byte offsets only make sense on the body as stored.
+    headers = {'Accept-Encoding': 'identity'}
+    if part_state:
+        headers['Range'] = 'bytes=%d-' % part_state['received']
+        validator = part_state['etag'] or part_state['last_modified']
+        if validator:
+            headers['If-Range'] = validator  # The full body is sent instead if the file has changed.
+
+    with http_get(file_url, stream=True, headers=headers) as response:
+        response.raise_for_status()
+        etag = response.headers.get('ETag')
+        is_resumed = part_state is not None and response.status_code == 206 and \
+            __get_range_start(response) == part_state['received'] and \
+            (not part_state['etag'] or not etag or etag == part_state['etag'])
+        if is_resumed:
+            # 'bytes 1000-4999/5000'
+            expected_size = int(response.headers.get('Content-Range', '').split('/')[-1].replace('*', '') or 0)
+            log('Resuming %s from %.1f MB.' % (file_url, part_state['received'] / 1000000))
+        elif response.status_code == 206:
+            # Not the range requested, or the file has changed: start over on the next attempt.
+            for path in (part_path, state_path):
+                if os.path.isfile(path):
+                    os.remove(path)
+            raise __PartialDownloadError(Exception('Unexpected range(%s)' % response.headers.get('Content-Range')),
+                                         0, 0)
+        else:  # Range ignored or validators changed: start over.
+            expected_size = int(response.headers.get('Content-Length') or 0)
+        part_state = {
+            'url': file_url,
+            'expected_size': expected_size,
+            'etag': etag,
+            'last_modified': response.headers.get('Last-Modified'),
+            'received': part_state['received'] if is_resumed else 0,
+        }
+        resumed_size = part_state['received']  # Advanced as the progress is recorded
+        file_size, digest = __write_response(response, part_path, state_path, part_state)
+
+    if os.path.isfile(state_path):
+        os.remove(state_path)
+    if is_stored:
+        is_duplicate = content_store.add(file_url, part_path, digest, file_path)
+    else:
+        os.replace(part_path, file_path)
+        is_duplicate = False
+    return file_size, file_size - resumed_size, is_duplicate
+
+
+def __write_response(response: requests.Response, part_path: str, state_path: str, part_state: dict) -> ():
+    # Write under a temporary name, renamed once complete: a file with the final name is never truncated.
+    # Returns (size, the hex digest of the content hashed as it is written).
+    offset = part_state['received']
+    expected_size = part_state['expected_size']
+    __save_part_state(state_path, part_state)
+    size = offset
+    saved_size = offset
+    content_hash = hashlib.new(Constants.DL_STORE_HASH)
+    try:
+        with open(part_path, 'r+b' if offset else 'wb', buffering=Constants.DL_WRITE_BUFFER_SIZE) as f:
+            if offset:
+                # Hash the bytes kept from the earlier attempts, leaving the position at the offset.
+                while f.tell() < offset:
+                    content_hash.update(f.read(min(Constants.DL_CHUNK_SIZE, offset - f.tell())))
+            elif Constants.DL_PREALLOCATE and expected_size and hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, expected_size)
+            for chunk in response.iter_content(chunk_size=Constants.DL_CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+                    content_hash.update(chunk)
+                    size += len(chunk)
+                    if size - saved_size >= Constants.DL_PART_STATE_INTERVAL:
+                        # Record the progress in case the process itself dies.
+                        f.flush()
+                        part_state['received'] = saved_size = size
+                        __save_part_state(state_path, part_state)
+            if size != expected_size:
+                f.truncate(size)  # Preallocated for a different size
+            f.flush()
+            if Constants.DL_FSYNC:
+                os.fsync(f.fileno())
+    except Exception as write_exception:
+        # Keep the bytes received so far to resume from.
+        part_state['received'] = size
+        __save_part_state(state_path, part_state)
+        raise __PartialDownloadError(write_exception, size, size - offset)
+    if expected_size and size < expected_size:
+        part_state['received'] = size
+        __save_part_state(state_path, part_state)
+        raise __PartialDownloadError(Exception('%d of %d bytes received' % (size, expected_size)), size, size - offset)
+    return size, content_hash.hexdigest()
+
+
+def __get_range_start(response: requests.Response) -> int:
+    # 1000 from 'bytes 1000-4999/5000'
+    try:
+        return int(response.headers['Content-Range'].split()[-1].split('-')[0])
+    except Exception:
+        return -1
+
+
+def __load_part_state(state_path: str, part_path: str, file_url: str):
+    # The state of a partial download of the same url, None if it cannot be resumed.
+    if not os.path.isfile(state_path) or not os.path.isfile(part_path):
+        return None
+    try:
+        with open(state_path, 'r') as f:
+            part_state = json.load(f)
+    except Exception as state_exception:
+        log('Warning: Cannot read %s.(%s)' % (state_path, state_exception))
+        return None
+    if part_state.get('url') != file_url or not part_state.get('received') \
+            or os.path.getsize(part_path) < part_state['received']:
+        return None
+    return part_state
+
+
+def remove_stale_parts(dir_path: str = Constants.DL_DESTINATION_PATH, expiry_sec: float = None) -> int:
+    # Remove the .part files(and their states) of the downloads not retried for expiry_sec. Returns the bytes freed.
+    if expiry_sec is None:
+        expiry_sec = Constants.DL_PART_EXPIRY_SEC
+    threshold = time.time() - expiry_sec
+    freed_size = 0
+    if not os.path.isdir(dir_path):
+        return 0
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if not entry.name.endswith((Constants.DL_PART_EXTENSION, Constants.DL_PART_EXTENSION + '.json')):
+                continue
+            try:
+                stat = entry.stat()
+                if entry.is_file() and stat.st_mtime < threshold:
+                    os.remove(entry.path)
+                    freed_size += stat.st_size
+            except FileNotFoundError:
+                pass  # Completed or removed meanwhile.
+    return freed_size
+
+
+def __save_part_state(state_path: str, part_state: dict):
+    with open(state_path, 'w') as f:
+        json.dump(part_state, f)
 
 
 def restore_img(int_index: str, reply_no: int, thread_no: int, file_name_format: str) -> str:
-    for file_name in os.listdir(Constants.DL_BACKUP_PATH):
-        if file_name.startswith(int_index + '-'):
-            extension = file_name.split('.')[-1]
-            formatted_file_name = file_name_format % (int_index, reply_no, thread_no, extension)
+    file_name = backup_index.take(int_index)
+    if file_name:
+        extension = file_name.split('.')[-1]
+        formatted_file_name = file_name_format % (int_index, reply_no, thread_no, extension)
+        try:
             os.rename(Constants.DL_BACKUP_PATH + file_name, Constants.DL_DESTINATION_PATH + formatted_file_name)
-            return formatted_file_name
+        except OSError:
+            backup_index.put_back(int_index, file_name)  # Still in the backup directory
+            raise
+        backup_index.acknowledge_change()  # Our own change: no need to rebuild.
+        return formatted_file_name
+
+
+def __format_direct_file_name(thread_no: int, reply_no: int, extension: str) -> str:
+    return '%d-%03d.%s' % (thread_no, reply_no, extension)
 
 
 def __extract_download_target(source_url: str, thread_no: int, reply_no: int,
@@ -167,34 +909,31 @@ def __extract_download_target(source_url: str, thread_no: int, reply_no: int,
     source_category, source_extension = retrieve_content_type(source_url)
 
     if source_category == 'image':  # The source is an image, download it directly.
-        return source_url, '%d-%03d.%s' % (thread_no, reply_no, source_extension)
+        return source_url, __format_direct_file_name(thread_no, reply_no, source_extension)
 
     domain = urlparse(source_url).netloc.replace('www', '')
     if source_url.strip().strip('/').endswith(domain):  # The domain itself: nothing to download.
         return
     domain = domain + ''
     if domain == 'imgdb.in':
-        source = requests.get(source_url).text
-        soup = BeautifulSoup(source, common.Constants.HTML_PARSER)
-        target_tag = soup.select_one('link')
+        resolution = __resolve_imgdb(source_url, thread_no)
+        if resolution is None:  # An unknown structure, which has been logged.
+            return
+        outcome, target_url = resolution
         file_name_format = '%s-%03d-%d.%s'
         # id's
         int_index = __format_url_index(__get_url_index(source_url))
-        if not target_tag:  # Empty
-            if '/?err=1";' in soup.select_one('script').text:
-                # ?err=1 redirects to "이미지가 삭제된 주소입니다."
-                # It's too late. Mark failure log.
-                log('[ - ] <- %.f" \t<- %.f"\t: %s #%d  \t-!->\t%s' %
-                    (prev_pause, prev_prev_pause, thread_url, reply_no, int_index),
-                    file_name=Constants.DL_LOG_FILE, has_tst=True)
-                # Try restoring.
-                restored_file_name = restore_img(int_index, reply_no, thread_no, file_name_format)
-                if restored_file_name:
-                    log("(Restored) %s" % (Constants.DUMP_PATH + restored_file_name), has_tst=True)
-                else:
-                    log('Sorry, cannot download %s.' % int_index, has_tst=True)
+        if outcome == 'deleted':
+            # It's too late. Mark failure log.
+            log('[ - ] <- %.f" \t<- %.f"\t: %s #%d  \t-!->\t%s' %
+                (prev_pause, prev_prev_pause, thread_url, reply_no, int_index),
+                file_name=Constants.DL_LOG_FILE, has_tst=True)
+            # Try restoring.
+            restored_file_name = restore_img(int_index, reply_no, thread_no, file_name_format)
+            if restored_file_name:
+                log("(Restored) %s" % (Constants.DUMP_PATH + restored_file_name), has_tst=True)
             else:
-                log('Error: Unknown structure on ' + domain + '\n\n' + soup.prettify(), file_name=str(thread_no))
+                log('Sorry, cannot download %s.' % int_index, has_tst=True)
         else:  # <link> tag present
             # Search from the backup folder to spare downloading.
             restored_file_name = restore_img(int_index, reply_no, thread_no, file_name_format)
@@ -204,7 +943,6 @@ def __extract_download_target(source_url: str, thread_no: int, reply_no: int,
                     % (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
                     file_name=Constants.DL_LOG_FILE)
             else:  # Not available from the backup, download the file.
-                target_url = target_tag['href']  # url of the file to download
                 imgdb_link_category, imgdb_link_extension = retrieve_content_type(target_url)
                 if imgdb_link_category != 'image':
                     log('Error: %s is not an image.' % source_url, has_tst=True)
@@ -216,156 +954,28 @@ def __extract_download_target(source_url: str, thread_no: int, reply_no: int,
         if (domain + '/success' in source_url) or (domain + '/delete' in source_url):
             return  # Not a downloadable link.
 
-        download_btn_xpath = '/html/body/div[2]/div/p/a'
-        submit_btn_xpath = '/html/body/div[1]/div/form/p/input'
-        pw_input_id = 'password'
-        tmp_browser = initiate_browser()
-        password_timeout = 3
-
-        def element_exists(element_id: str):
-            try:
-                tmp_browser.find_element(By.ID, element_id)
-            except selenium.common.exceptions.NoSuchElementException:
-                return False
-            return True
-
-        try:
-            tmp_browser.get(source_url)
-            if element_exists(pw_input_id):
-                wait = WebDriverWait(tmp_browser, password_timeout)
-                for password in Constants.PASSWORDS:
-                    tmp_browser.find_element(By.ID, pw_input_id).clear()
-                    tmp_browser.find_element(By.ID, pw_input_id).send_keys(password)
-                    tmp_browser.find_element(By.XPATH, submit_btn_xpath).click()
-                    try:
-                        wait.until(expected_conditions.presence_of_element_located((By.XPATH, download_btn_xpath)))
-                        log('%s: Password matched.' % password)
-                        break
-                    except selenium.common.exceptions.TimeoutException:
-                        print('Error: Incorrect password %s.' % password)
-                    except Exception as e:
-                        print('Error: Incorrect password %s(%s).' % (password, e))
-            common.check_dir_exists(Constants.DL_TMP_PATH)
-            tmp_browser.find_element(By.XPATH, download_btn_xpath).click()
-            is_dl_successful = wait_finish_downloading(Constants.DL_TMP_PATH, 280)
-            if is_dl_successful:
-                for file_name in os.listdir(Constants.DL_TMP_PATH):
-                    formatted_file_name = '%s-%s-%03d-%s' % \
-                                          (domain.strip('.com'), thread_no, reply_no, __format_file_name(file_name))
-                    os.rename(Constants.DL_TMP_PATH + file_name, Constants.DL_DESTINATION_PATH + formatted_file_name)
-                    log("%s" % (Constants.DUMP_PATH + formatted_file_name), has_tst=True)
-                    log('[ V ] <- %.f" \t<- %.f"\t: %s #%d  \t->  \t%s'
-                        % (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
-                        file_name=Constants.DL_LOG_FILE)
-            else:
-                log('Download button located, but failed to download.')
-                log('[ - ] <- %.f" \t<- %.f"\t: %s #%d  \t-!->\t%s' %
-                    (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
-                    file_name=Constants.DL_LOG_FILE, has_tst=True)
-        except selenium.common.exceptions.NoSuchElementException:
-            err_soup = BeautifulSoup(tmp_browser.page_source, common.Constants.HTML_PARSER)
-            if err_soup.select_one('div#expired > p.notice'):
-                log('Sorry, the link has been expired.', has_tst=True)
-                log('[ - ] <- %.f" \t<- %.f"\t: %s #%d  \t-!->\t%s' %
-                    (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
-                    file_name=Constants.DL_LOG_FILE, has_tst=True)
-            elif err_soup.select_one('div#delete > p.delete'):
-                log('Error: Cannot locate the download button(삭제하시겠습니까?).', has_tst=True)
-            else:
-                log('Error: Cannot locate the download button.', has_tst=True)
-                log('Error: Cannot locate the download button.\n[Page source]\n' + err_soup.prettify(), str(thread_no))
-        except FileNotFoundError as file_exception:
-            log('Error: The local file not found.\n%s' % file_exception)
-        except Exception as tmpstorage_exception:
-            file_name = 'exception-tmpstorage.pv'
-            log('Error: Cannot retrieve tmpstorage source(%s).' % tmpstorage_exception, has_tst=True)
-            log('Exception: %s\n\n[Traceback]\n%s' %
-                (tmpstorage_exception, traceback.format_exc()), file_name)
-            err_soup = BeautifulSoup(tmp_browser.page_source, common.Constants.HTML_PARSER)
-            log('\n\n[Page source]\n' + err_soup.prettify(), file_name)
-        finally:
-            tmp_browser.quit()
-            common.check_dir_exists(Constants.DL_TMP_PATH)
-            for file_name in os.listdir(Constants.DL_TMP_PATH):  # Clear the tmp directory.
-                os.rename(Constants.DL_TMP_PATH + file_name, Constants.DL_DESTINATION_PATH + file_name)
-                log("%s" % (Constants.DUMP_PATH + file_name), has_tst=True)
-                log('[ / ] <- %.f" \t<- %.f"\t: %s #%d  \t->  \t%s' %
-                    (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
-                    file_name=Constants.DL_LOG_FILE)
+        with browser_pool.lease() as (tmp_browser, tmp_dir):
+            __download_from_tmpstorage(tmp_browser, tmp_dir, source_url, thread_no, reply_no,
+                                       prev_pause, prev_prev_pause)
 
     elif domain == 'ibb.co':
-        source = requests.get(source_url).text
-        soup = BeautifulSoup(source, common.Constants.HTML_PARSER)
-        target_tag = soup.select_one('div#image-viewer-container > img')
-        if not target_tag:  # An empty tag, returning None.
-            if soup.select_one('div.page-not-found'):
-                log('Sorry, annot download imgbb link.', has_tst=True)
-            else:
-                log('Error: Unknown structure on ' + domain + '\n\n' + soup.prettify(), str(thread_no))
+        resolution = __resolve_ibb(source_url, thread_no)
+        if resolution is None:  # An unknown structure, which has been logged.
+            return
+        outcome, target_url = resolution
+        if outcome == 'page-not-found':
+            log('Sorry, annot download imgbb link.', has_tst=True)
         else:  # The image link tag present
             # Try retrieving the link.
-            target_url = target_tag['src']
             file_name = common.split_on_last_pattern(target_url, '/')[-1]
 
             formatted_file_name = '%s-%s-%02d-%s' % ('ibb', thread_no, reply_no, __format_file_name(file_name))
             return target_url, formatted_file_name
 
     elif domain == 'postimg.cc':
-        download_btn_id = 'download'
-        tmp_browser = initiate_browser()
-        timeout = 10
-
-        try:
-            tmp_browser.get(source_url)
-            wait = WebDriverWait(tmp_browser, timeout)
-            wait.until(expected_conditions.presence_of_element_located((By.ID, download_btn_id)))
-
-            common.check_dir_exists(Constants.DL_TMP_PATH)
-            tmp_browser.find_element(By.ID, download_btn_id).click()
-            is_dl_successful = wait_finish_downloading(Constants.DL_TMP_PATH, 280)
-            if is_dl_successful:
-                for file_name in os.listdir(Constants.DL_TMP_PATH):
-                    formatted_file_name = '%s-%s-%03d-%s' % \
-                                          ('postimg', thread_no, reply_no, __format_file_name(file_name))
-                    os.rename(Constants.DL_TMP_PATH + file_name, Constants.DL_DESTINATION_PATH + formatted_file_name)
-                    log("%s" % (Constants.DUMP_PATH + formatted_file_name), has_tst=True)
-                    log('[ V ] <- %.f" \t<- %.f"\t: %s #%d  \t->  \t%s'
-                        % (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
-                        file_name=Constants.DL_LOG_FILE)
-        except selenium.common.exceptions.TimeoutException:
-            # Try downloading posted image instead of the original image.
-            source = requests.get(source_url).text
-            soup = BeautifulSoup(source, common.Constants.HTML_PARSER)
-            target_tag = soup.select_one('img#main-image')
-            if target_tag:
-                target_url = target_tag['src']
-                file_name = common.split_on_last_pattern(target_url, '/')[-1]
-                formatted_file_name = '%s-%s-%03d-%s' % \
-                                      ('postimg', thread_no, reply_no, __format_file_name(file_name))
-                return target_url, formatted_file_name
-            else:  # An empty tag, returning None.
-                log('Sorry, cannot download postimg link.' % reply_no, has_tst=True)
-                log('[ - ] <- %.f" \t<- %.f"\t: %s #%d  \t-!->\t%s' %
-                    (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
-                    file_name=Constants.DL_LOG_FILE, has_tst=True)
-        except FileNotFoundError as file_exception:
-            log('Error: The local file not found.\n%s' % file_exception)
-        except Exception as postimg_exception:
-            file_name = 'exception-postimg.pv'
-            log('Error: Cannot retrieve postimg source(%s).' % postimg_exception, has_tst=True)
-            log('Exception: %s\n\n[Traceback]\n%s' %
-                (postimg_exception, traceback.format_exc()), file_name)
-            err_soup = BeautifulSoup(tmp_browser.page_source, common.Constants.HTML_PARSER)
-            log('\n\n[Page source]\n' + err_soup.prettify(), file_name)
-        finally:
-            tmp_browser.quit()
-            common.check_dir_exists(Constants.DL_TMP_PATH)
-            for file_name in os.listdir(Constants.DL_TMP_PATH):  # Clear the tmp directory.
-                os.rename(Constants.DL_TMP_PATH + file_name, Constants.DL_DESTINATION_PATH + file_name)
-                log("%s" % (Constants.DUMP_PATH + file_name), has_tst=True)
-                log('[ / ] <- %.f" \t<- %.f"\t: %s #%d  \t->  \t%s' %
-                    (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
-                    file_name=Constants.DL_LOG_FILE)
+        with browser_pool.lease() as (tmp_browser, tmp_dir):
+            return __download_from_postimg(tmp_browser, tmp_dir, source_url, thread_no, reply_no,
+                                           prev_pause, prev_prev_pause)
 
     elif domain == 'tmpfiles.org':
         log('Unusual upload: tmpfiles.org.')
@@ -385,12 +995,217 @@ def __extract_download_target(source_url: str, thread_no: int, reply_no: int,
         log('Warning: Unknown source at #%d.(%s)' % (reply_no, source_url))
 
 
+def __resolve_imgdb(source_url: str, thread_no: int) -> ():
+    # ('resolved', url of the file) or ('deleted', None)
+    resolution = resolution_cache.get('target', source_url)
+    if resolution:
+        return resolution
+
+    source = http_get(source_url).text
+    soup = BeautifulSoup(source, common.Constants.HTML_PARSER)
+    target_tag = soup.select_one('link')
+    if target_tag:
+        resolution = ['resolved', target_tag['href']]
+    elif '/?err=1";' in soup.select_one('script').text:
+        # ?err=1 redirects to "이미지가 삭제된 주소입니다."
+        resolution = ['deleted', None]
+    else:
+        log('Error: Unknown structure on imgdb.in\n\n' + soup.prettify(), file_name=str(thread_no))
+        return
+    resolution_cache.put('target', source_url, resolution[0], resolution)
+    return resolution
+
+
+def __resolve_ibb(source_url: str, thread_no: int) -> ():
+    # ('resolved', url of the image) or ('page-not-found', None)
+    resolution = resolution_cache.get('target', source_url)
+    if resolution:
+        return resolution
+
+    source = http_get(source_url).text
+    soup = BeautifulSoup(source, common.Constants.HTML_PARSER)
+    target_tag = soup.select_one('div#image-viewer-container > img')
+    if target_tag:
+        resolution = ['resolved', target_tag['src']]
+    elif soup.select_one('div.page-not-found'):
+        resolution = ['page-not-found', None]
+    else:
+        log('Error: Unknown structure on ibb.co\n\n' + soup.prettify(), str(thread_no))
+        return
+    resolution_cache.put('target', source_url, resolution[0], resolution)
+    return resolution
+
+
+def __download_from_tmpstorage(tmp_browser: webdriver.Chrome, tmp_dir: str, source_url: str, thread_no: int,
+                               reply_no: int, prev_pause: float, prev_prev_pause: float):
+    domain = 'tmpstorage.com'
+    thread_url = common.get_thread_url(thread_no)  # The url of the thread quoting the source
+    download_btn_xpath = '/html/body/div[2]/div/p/a'
+    submit_btn_xpath = '/html/body/div[1]/div/form/p/input'
+    pw_input_id = 'password'
+    password_timeout = 3
+
+    def element_exists(element_id: str):
+        try:
+            tmp_browser.find_element(By.ID, element_id)
+        except selenium.common.exceptions.NoSuchElementException:
+            return False
+        return True
+
+    is_browser_reusable = True  # Unless a download may still be running in it
+    try:
+        tmp_browser.get(source_url)
+        if element_exists(pw_input_id):
+            wait = WebDriverWait(tmp_browser, password_timeout)
+            for password in Constants.PASSWORDS:
+                tmp_browser.find_element(By.ID, pw_input_id).clear()
+                tmp_browser.find_element(By.ID, pw_input_id).send_keys(password)
+                tmp_browser.find_element(By.XPATH, submit_btn_xpath).click()
+                try:
+                    wait.until(expected_conditions.presence_of_element_located((By.XPATH, download_btn_xpath)))
+                    log('%s: Password matched.' % password)
+                    break
+                except selenium.common.exceptions.TimeoutException:
+                    print('Error: Incorrect password %s.' % password)
+                except Exception as e:
+                    print('Error: Incorrect password %s(%s).' % (password, e))
+        common.check_dir_exists(tmp_dir)
+        is_browser_reusable = False
+        tmp_browser.find_element(By.XPATH, download_btn_xpath).click()
+        is_dl_successful, dl_size, dl_elapsed_sec = wait_finish_downloading(tmp_dir, 280)
+        is_browser_reusable = is_dl_successful
+        if is_dl_successful:
+            for file_name in os.listdir(tmp_dir):
+                formatted_file_name = '%s-%s-%03d-%s' % \
+                                      (domain.strip('.com'), thread_no, reply_no, __format_file_name(file_name))
+                os.rename(tmp_dir + file_name, Constants.DL_DESTINATION_PATH + formatted_file_name)
+                log("%s" % (Constants.DUMP_PATH + formatted_file_name), has_tst=True)
+                log('[ V ] <- %.f" \t<- %.f"\t: %s #%d  \t->  \t%s\t(%.1f MB, %.2f MB/s)'
+                    % (prev_pause, prev_prev_pause, thread_url, reply_no, source_url,
+                       dl_size / 1000000, dl_size / 1000000 / dl_elapsed_sec),
+                    file_name=Constants.DL_LOG_FILE)
+        else:
+            log('Download button located, but failed to download.')
+            log('[ - ] <- %.f" \t<- %.f"\t: %s #%d  \t-!->\t%s' %
+                (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
+                file_name=Constants.DL_LOG_FILE, has_tst=True)
+    except selenium.common.exceptions.NoSuchElementException:
+        err_soup = BeautifulSoup(tmp_browser.page_source, common.Constants.HTML_PARSER)
+        if err_soup.select_one('div#expired > p.notice'):
+            log('Sorry, the link has been expired.', has_tst=True)
+            log('[ - ] <- %.f" \t<- %.f"\t: %s #%d  \t-!->\t%s' %
+                (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
+                file_name=Constants.DL_LOG_FILE, has_tst=True)
+        elif err_soup.select_one('div#delete > p.delete'):
+            log('Error: Cannot locate the download button(삭제하시겠습니까?).', has_tst=True)
+        else:
+            log('Error: Cannot locate the download button.', has_tst=True)
+            log('Error: Cannot locate the download button.\n[Page source]\n' + err_soup.prettify(), str(thread_no))
+    except FileNotFoundError as file_exception:
+        log('Error: The local file not found.\n%s' % file_exception)
+    except Exception as tmpstorage_exception:
+        is_browser_reusable = False
+        file_name = 'exception-tmpstorage.pv'
+        log('Error: Cannot retrieve tmpstorage source(%s).' % tmpstorage_exception, has_tst=True)
+        log('Exception: %s\n\n[Traceback]\n%s' %
+            (tmpstorage_exception, traceback.format_exc()), file_name)
+        err_soup = BeautifulSoup(tmp_browser.page_source, common.Constants.HTML_PARSER)
+        log('\n\n[Page source]\n' + err_soup.prettify(), file_name)
+    finally:
+        if not is_browser_reusable:  # Stop the download before moving its file away.
+            browser_pool.recycle(tmp_browser)
+        common.check_dir_exists(tmp_dir)
+        for file_name in os.listdir(tmp_dir):  # Clear the tmp directory.
+            os.rename(tmp_dir + file_name, Constants.DL_DESTINATION_PATH + file_name)
+            log("%s" % (Constants.DUMP_PATH + file_name), has_tst=True)
+            log('[ / ] <- %.f" \t<- %.f"\t: %s #%d  \t->  \t%s' %
+                (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
+                file_name=Constants.DL_LOG_FILE)
+
+
+def __download_from_postimg(tmp_browser: webdriver.Chrome, tmp_dir: str, source_url: str, thread_no: int,
+                            reply_no: int, prev_pause: float, prev_prev_pause: float) -> ():
+    thread_url = common.get_thread_url(thread_no)  # The url of the thread quoting the source
+    download_btn_id = 'download'
+    timeout = 10
+
+    is_browser_reusable = True  # Unless a download may still be running in it
+    try:
+        tmp_browser.get(source_url)
+        wait = WebDriverWait(tmp_browser, timeout)
+        wait.until(expected_conditions.presence_of_element_located((By.ID, download_btn_id)))
+
+        common.check_dir_exists(tmp_dir)
+        is_browser_reusable = False
+        tmp_browser.find_element(By.ID, download_btn_id).click()
+        is_dl_successful, dl_size, dl_elapsed_sec = wait_finish_downloading(tmp_dir, 280)
+        is_browser_reusable = is_dl_successful
+        if is_dl_successful:
+            for file_name in os.listdir(tmp_dir):
+                formatted_file_name = '%s-%s-%03d-%s' % \
+                                      ('postimg', thread_no, reply_no, __format_file_name(file_name))
+                os.rename(tmp_dir + file_name, Constants.DL_DESTINATION_PATH + formatted_file_name)
+                log("%s" % (Constants.DUMP_PATH + formatted_file_name), has_tst=True)
+                log('[ V ] <- %.f" \t<- %.f"\t: %s #%d  \t->  \t%s\t(%.1f MB, %.2f MB/s)'
+                    % (prev_pause, prev_prev_pause, thread_url, reply_no, source_url,
+                       dl_size / 1000000, dl_size / 1000000 / dl_elapsed_sec),
+                    file_name=Constants.DL_LOG_FILE)
+    except selenium.common.exceptions.TimeoutException:
+        # Try downloading posted image instead of the original image.
+        source = http_get(source_url).text
+        soup = BeautifulSoup(source, common.Constants.HTML_PARSER)
+        target_tag = soup.select_one('img#main-image')
+        if target_tag:
+            target_url = target_tag['src']
+            file_name = common.split_on_last_pattern(target_url, '/')[-1]
+            formatted_file_name = '%s-%s-%03d-%s' % \
+                                  ('postimg', thread_no, reply_no, __format_file_name(file_name))
+            return target_url, formatted_file_name
+        else:  # An empty tag, returning None.
+            log('Sorry, cannot download postimg link.' % reply_no, has_tst=True)
+            log('[ - ] <- %.f" \t<- %.f"\t: %s #%d  \t-!->\t%s' %
+                (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
+                file_name=Constants.DL_LOG_FILE, has_tst=True)
+    except FileNotFoundError as file_exception:
+        log('Error: The local file not found.\n%s' % file_exception)
+    except Exception as postimg_exception:
+        is_browser_reusable = False
+        file_name = 'exception-postimg.pv'
+        log('Error: Cannot retrieve postimg source(%s).' % postimg_exception, has_tst=True)
+        log('Exception: %s\n\n[Traceback]\n%s' %
+            (postimg_exception, traceback.format_exc()), file_name)
+        err_soup = BeautifulSoup(tmp_browser.page_source, common.Constants.HTML_PARSER)
+        log('\n\n[Page source]\n' + err_soup.prettify(), file_name)
+    finally:
+        if not is_browser_reusable:  # Stop the download before moving its file away.
+            browser_pool.recycle(tmp_browser)
+        common.check_dir_exists(tmp_dir)
+        for file_name in os.listdir(tmp_dir):  # Clear the tmp directory.
+            os.rename(tmp_dir + file_name, Constants.DL_DESTINATION_PATH + file_name)
+            log("%s" % (Constants.DUMP_PATH + file_name), has_tst=True)
+            log('[ / ] <- %.f" \t<- %.f"\t: %s #%d  \t->  \t%s' %
+                (prev_pause, prev_prev_pause, thread_url, reply_no, source_url),
+                file_name=Constants.DL_LOG_FILE)
+
+
 def retrieve_content_type(target_url):
-    session = requests.Session()
+    # ['image', 'jpeg'] from 'image/jpeg', reading the headers only.
+    content_type = resolution_cache.get('content-type', target_url)
+    if content_type:
+        return content_type
+    start_time = time.monotonic()
     try:
-        headers = session.get(target_url).headers['Content-Type'].split('/')
-        return headers
+        response = http_session.head(target_url, allow_redirects=True, timeout=Constants.HTTP_TIMEOUT)
+        content_type = response.headers.get('Content-Type') if response.ok else None
+        if not content_type:
+            # HEAD not supported: close the response as soon as the headers arrive.
+            with http_get(target_url, stream=True) as response:
+                content_type = response.headers['Content-Type']
+        content_type = content_type.split(';')[0].strip().split('/')
+        resolution_cache.put('content-type', target_url, 'content-type', content_type)
+        return content_type
     except Exception as header_exception:
         log('Error: The source has a wrong header.(%s)' % header_exception)
     finally:
-        session.close()
+        metrics.observe('fscr_content_type_seconds', time.monotonic() - start_time,
+                        host=urlparse(target_url).netloc.replace('www.', ''))
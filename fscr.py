@@ -8,13 +8,22 @@ from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions
-import bs4
 from bs4 import BeautifulSoup
+from html.parser import HTMLParser
 import random
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import sqlite
 import downloader
+import thread_page
+import reply_analyzer
+import metrics
+import json
+import scheduler
 
 
 class Constants:
@@ -38,6 +47,42 @@ class Constants:
     IGNORED_REPLY_PATTERNS = common.build_tuple('IGNORED_REPLY_PATTERNS.pv')
     HOT_THRESHOLD_SEC = 200
 
+    # 'browser': render every page on Chrome
+    # 'http'(opt-in): fetch the pages directly with the login cookies of Chrome, falling back to Chrome on failure
+    FETCH_MODE = 'browser'
+    LOGGED_IN_CLASS_NAME = 'user-email'
+
+    # The changed threads fetched and parsed at once in the 'http' fetch mode. 1 to scan one by one.
+    SCAN_CONCURRENCY = 4
+    SCAN_MIN_INTERVAL_SEC = 0.4  # Between the requests of the workers, to stay under the abuse threshold
+    CYCLE_LOG_FILE = 'log-cycle.pv'
+
+    # The counters and latencies of the phases: Prometheus text on http://127.0.0.1:METRICS_PORT/metrics(None not
+    # to serve), and a JSON line per cycle in METRICS_LOG_FILE
+    METRICS_PORT = 9108
+    METRICS_LOG_FILE = 'log-metrics.pv'
+
+    # The hot threads are checked on their own between the list scans, as scheduler.ThreadScheduler finds them due.
+    SCHEDULED_CHECKS_ENABLED = True
+    MAX_SCHEDULED_CHECKS_PER_PAUSE = 12  # On top of SCAN_MIN_INTERVAL_SEC between the checks
+    SCHEDULER_SEED_HOURS = 6  # The threads updated within this period are tracked from the start.
+
+    # The replies scrolled off the thread page since the last scan(beyond MAX_REPLIES_VISIBLE) are read on the range
+    # pages: {thread_url}, and the reply numbers {first}-{last} inclusive, e.g. '{thread_url}/{first}-{last}' as served
+    # by standin_server.py. None to skip them: to be set once confirmed against the board.
+    CATCH_UP_URL_TEMPLATE = None
+    MAX_CATCH_UP_PAGES_PER_CYCLE = 8  # The rest left unread, not to delay the cycle
+
+
+# Built once from the pattern files: every title and reply is matched in a single pass.
+ignored_title_matcher = reply_analyzer.PatternMatcher(Constants.IGNORED_TITLE_PATTERNS)
+reply_content_analyzer = reply_analyzer.ReplyAnalyzer(Constants.IGNORED_REPLY_PATTERNS)
+
+# The session exported from the browser in the 'http' fetch mode, None until logged in. Replaced by the main thread,
+# dropped by any thread on finding it logged out.
+page_session = None
+page_session_lock = threading.Lock()
+
 
 def initiate_browser():
     # A Chrome web driver with headless option
@@ -73,48 +118,196 @@ def wait_and_retry(wait: WebDriverWait, class_name: str, max_trial: int = 2, pre
 
 def log_page_source(msg: str = None, file_name: str = common.Constants.LOG_FILE):
     try:
-        html_source = BeautifulSoup(browser.page_source, common.Constants.HTML_PARSER).prettify()
+        html_source = last_page_source  # As it is: parsing and prettifying a whole page costs more than logging it.
         formatted_msg = '%s\n\n[Page source]\n%s' % (msg, html_source) if msg else html_source
         log(formatted_msg, file_name)
     except Exception as page_source_exception:
         log('Error: cannot print page source.(%s)' % page_source_exception)
 
 
-def scan_thread(thread_id: int, last_reply_count: int, head_only: bool, is_reply_count_readable: bool):
-    # Open the page to scan
-    thread_url = common.get_thread_url(thread_id)  # Edit here to debug individual threads. e.g. 'file:///*/main.html'
-    browser.get(thread_url)
+def export_cookies(driver: webdriver.Chrome) -> requests.Session:
+    # A session carrying the login of the browser
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = driver.execute_script('return navigator.userAgent')
+    for cookie in driver.get_cookies():
+        session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'), path=cookie.get('path', '/'))
+    return session
+
+
+def get_page_session():
+    with page_session_lock:
+        return page_session
 
+
+def set_page_session(session):
+    # Replace the session, closing the old one with its pooled connections.
+    global page_session
+    with page_session_lock:
+        old_session, page_session = page_session, session
+    if old_session is not None:
+        old_session.close()
+
+
+def discard_page_session(session):
+    # Logged out: drop the session, unless another thread has replaced it already.
+    global page_session
+    with page_session_lock:
+        if page_session is not session:
+            return
+        page_session = None
+    session.close()
+
+
+class ClassFinder(HTMLParser):
+    # Stops at the first tag of the class. The same text within the replies is not a tag, thus never matched.
+    class Found(Exception):
+        pass
+
+    def __init__(self, class_name: str):
+        super().__init__(convert_charrefs=False)
+        self.class_name = class_name
+
+    def handle_starttag(self, tag, attrs):
+        for name, value in attrs:
+            if name == 'class' and value and self.class_name in value.split():
+                raise ClassFinder.Found()
+
+
+def has_class(page_source: str, class_name: str) -> bool:
+    try:
+        ClassFinder(class_name).feed(page_source)
+    except ClassFinder.Found:
+        return True
+    return False
+
+
+def __find_meta_charset(content: bytes):
+    # The charset of <meta charset> or <meta http-equiv="Content-Type">, within the head
+    charset_match = re.search(rb'<meta[^>]+charset=["\']?([\w-]+)', content[:4096], re.IGNORECASE)
+    return charset_match.group(1).decode('ascii') if charset_match else None
+
+
+def fetch_page_source(url: str, ready_class_name: str):
+    # The page source fetched without the browser, None if the page is not usable as it is.
+    session = get_page_session()
+    if session is None:
+        return None  # Not logged in on the browser yet.
+    try:
+        response = session.get(url, timeout=Constants.HTML_TIMEOUT)
+    except requests.exceptions.RequestException as fetch_exception:
+        log('Warning: Cannot fetch %s(%s).' % (url, fetch_exception))
+        return None
+    if 'charset' not in response.headers.get('Content-Type', '').lower():
+        # requests would decode it as ISO-8859-1: take the page's own declaration, or a guess from the bytes.
+        response.encoding = __find_meta_charset(response.content) or response.apparent_encoding
+    page_source = response.text
+    if not response.ok or not has_class(page_source, Constants.LOGGED_IN_CLASS_NAME):
+        # Logged out: log in again on the browser and export the new cookies.
+        log('Warning: Fetching %s failed(%d, logged out?). Falling back to the browser.' %
+            (url, response.status_code), has_tst=True)
+        discard_page_session(session)
+        return None
+    if not has_class(page_source, ready_class_name):
+        # Rendered by scripts: only the browser can read it.
+        log('Warning: %s missing on %s. Falling back to the browser.' % (ready_class_name, url), has_tst=True)
+        return None
+    return page_source
+
+
+def load_page(url: str, ready_class_name: str, presence_of_all: bool = False):
+    # (page source, whether ready_class_name is present) after login, None if the login has failed.
+    global last_page_source
+    if Constants.FETCH_MODE == 'http':
+        page_source = fetch_page_source(url, ready_class_name)
+        if page_source is not None:
+            last_page_source = page_source
+            return page_source, True
+
+    browser.get(url)
     is_privileged = check_privilege(browser)
     if not is_privileged:
         # Possibly banned for abuse. Cool down.
-        time.sleep(fluctuate(340))
+        cool_down(fluctuate(340))
         return
-    elif browser.current_url != thread_url:
-        browser.get(thread_url)
+    elif browser.current_url != url:
+        browser.get(url)
+    if Constants.FETCH_MODE == 'http' and get_page_session() is None:
+        set_page_session(export_cookies(browser))
+
+    is_loaded = wait_and_retry(browser_wait, ready_class_name, presence_of_all=presence_of_all)
+    last_page_source = browser.page_source
+    return last_page_source, is_loaded
+
+
+class RateLimiter:
+    # Spaces out the calls of wait() from any thread by min_interval_sec at least.
+    def __init__(self, min_interval_sec: float):
+        self.min_interval_sec = min_interval_sec
+        self.next_allowed_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_sec = max(self.next_allowed_time - now, 0)
+            self.next_allowed_time = max(self.next_allowed_time, now) + self.min_interval_sec
+        if wait_sec:
+            time.sleep(wait_sec)
+
+
+def get_ready_class_name(head_only: bool) -> str:
+    # Do not wait for 'thread-reply' on a thread with the head reply(#1) only, which doesn't exist yet.
+    return 'th-contents' if head_only else 'thread-reply'
+
+
+def prefetch_thread(thread_id: int, head_only: bool):
+    # Run on the workers: (page source, ThreadPage) of the thread, None to load it on the browser instead.
+    scan_rate_limiter.wait()
+    with metrics.timed('fscr_page_load_seconds', page='thread', mode='prefetch'):
+        page_source = fetch_page_source(common.get_thread_url(thread_id), get_ready_class_name(head_only))
+    if page_source is None:
+        return None
+    return page_source, thread_page.parse_thread_page(page_source)
+
+
+def scan_thread(thread_id: int, last_reply_count: int, head_only: bool, is_reply_count_readable: bool,
+                thread_updates: list, prefetched_page: tuple = None):
+    global last_page_source
+    # Open the page to scan
+    thread_url = common.get_thread_url(thread_id)  # Edit here to debug individual threads. e.g. 'file:///*/main.html'
+    if prefetched_page:
+        page_source, page = prefetched_page
+        last_page_source = page_source
+        is_loaded = True
+    else:
+        with metrics.timed('fscr_page_load_seconds', page='thread', mode=Constants.FETCH_MODE):
+            loaded_page = load_page(thread_url, get_ready_class_name(head_only))
+        if loaded_page is None:
+            return
+        page_source, is_loaded = loaded_page
+        page = None
 
     if head_only:  # Hardly called. A thread with the head reply(#1) only.
-        # Do not wait for 'thread-reply' which doesn't exist yet.
-        is_loaded = wait_and_retry(browser_wait, 'th-contents')
         if not is_loaded:
             log('Error: Cannot scan the only reply. (%s)' % thread_url)
             log_page_source(file_name='exception-only-reply.pv')
-        head_reply_soup = BeautifulSoup(browser.page_source, common.Constants.HTML_PARSER)
+        head_reply_page = page if page else thread_page.parse_thread_page(page_source)
         if is_reply_count_readable:
-            thread_db.update_thread(thread_id, 1)
+            thread_updates.append((thread_id, 1))
         else:
             # Prevent further scanning.
-            thread_db.update_thread(thread_id, Constants.MAX_REPLIES_POSSIBLE)
-        scan_head(head_reply_soup, thread_id, thread_url)
+            thread_updates.append((thread_id, Constants.MAX_REPLIES_POSSIBLE))
+        scan_head(head_reply_page, thread_id, thread_url)
     else:
-        is_loaded = wait_and_retry(browser_wait, 'thread-reply')
         if not is_loaded:
             log('Error: Cannot scan replies after %.f". (%s)' % (prev_pause, thread_url))
             log_page_source(file_name='exception-replies.pv')
         # Get the thread list and the scanning targets(the new replies)
-        replies_soup = BeautifulSoup(browser.page_source, common.Constants.HTML_PARSER)
-        reply_count_class_name = 'reply-count'
-        reply_count_str = replies_soup.select_one('span.%s' % reply_count_class_name).text
+        replies_page = page if page else thread_page.parse_thread_page(page_source)
+        reply_count_str = replies_page.reply_count_str
         if reply_count_str.isdigit():
             asserted_reply_count = int(reply_count_str)
         else:
@@ -126,8 +319,7 @@ def scan_thread(thread_id: int, last_reply_count: int, head_only: bool, is_reply
                 log('Error: The reply count has an unexpected content(%s).\n(%s)' %
                     (reply_count_str, thread_url), has_tst=True)
         try:
-            last_reply_no = replies_soup.select('span.reply-offset')[-1].text.strip().strip('#')
-            current_reply_count = int(last_reply_no)
+            current_reply_count = int(replies_page.last_reply_no)
         except Exception as last_reply_no_exception:
             log('Error: The last reply number cannot be retrieved(%s).' % last_reply_no_exception)
             log_page_source(file_name='exception-last-reply-no.pv')
@@ -138,184 +330,188 @@ def scan_thread(thread_id: int, last_reply_count: int, head_only: bool, is_reply
 
         current_count_to_scan = current_reply_count - last_reply_count
         if is_reply_count_readable:
-            thread_db.update_thread(thread_id, current_reply_count)
+            thread_updates.append((thread_id, current_reply_count))
         else:
             # Prevent further scanning.
-            thread_db.update_thread(thread_id, Constants.MAX_REPLIES_POSSIBLE)
-        replies = replies_soup.select('div.thread-reply')
+            thread_updates.append((thread_id, Constants.MAX_REPLIES_POSSIBLE))
+        if current_count_to_scan <= 0:
+            return  # Nothing new since the last scan: replies[-0:] would be all of them.
+        replies = replies_page.replies
 
         if not replies or len(replies) < current_count_to_scan:  # The #1 needs scanning.
-            scan_head(replies_soup, thread_id, thread_url)
+            scan_head(replies_page, thread_id, thread_url)
 
-        # Now scan the new replies.
+        # The replies scrolled off the page, then the new replies on the page
+        if replies and replies[0].no is not None:
+            catch_up_replies(replies_page, thread_id, thread_url, last_reply_count, replies[0].no)
         new_replies = replies[-current_count_to_scan:]
+        metrics.inc('fscr_replies_scanned_total', len(new_replies))
         for reply in new_replies:
-            scan_content(replies_soup, reply, thread_id, thread_url)
+            scan_content(replies_page, reply, thread_id, thread_url)
 
 
-def has_specs(reply) -> bool:
-    col_pt = 0
-    content_str = ''
-    for content in reply.select_one('div.th-contents'):
-        if not isinstance(content, bs4.element.Tag):  # Plain text
-            content_str += content.text + '\n'
-    if re.search("(^|[^0-9])[6-9][0|5].{0,8}[a-k]", content_str, re.IGNORECASE):
-        return True
-    if re.search("[1-9][0-9].{0,4}[a-k]", content_str, re.IGNORECASE):
-        if not re.search("[a-k][a-z]", content_str, re.IGNORECASE):
-            return True
-    if re.search("(^|[^0-9])1[4-7][0-9nox]([^0-9시분초개대번~]|$)", content_str, re.IGNORECASE):
-        col_pt += 1
-    if re.search("(^|[^0-9])[1-3][0-9nox]([^0-9시분초개대번~]|$)", content_str, re.IGNORECASE):
-        col_pt += 1
-    if re.search("(^|[^0-9])[4-6][0-9nox]([^0-9시분초개대번~]|$)", content_str, re.IGNORECASE):
-        col_pt += 1
-    if col_pt >= 2:
-        return True
-    else:
-        return False
+def get_missed_ranges(last_reply_count: int, first_visible_no: int) -> list:
+    # [(first, last), ...] of the replies between the last scan and the page, a page each
+    first_missed_no = max(last_reply_count + 1, 2)  # The #1 is on every page.
+    return [(first, min(first + Constants.MAX_REPLIES_VISIBLE - 1, first_visible_no - 1))
+            for first in range(first_missed_no, first_visible_no, Constants.MAX_REPLIES_VISIBLE)]
+
+
+def get_range_url(thread_url: str, first: int, last: int) -> str:
+    return Constants.CATCH_UP_URL_TEMPLATE.format(thread_url=thread_url, first=first, last=last)
 
 
-def has_contacts(reply) -> str:
-    content_str = ''
-    for content in reply.select_one('div.th-contents'):
-        if not isinstance(content, bs4.element.Tag):  # Plain text
-            content_str += content.text + '\n'
-    if re.search("라인|아이디|ID|텔레", content_str, re.IGNORECASE):
-        id_match = re.search("[a-z][0-9a-z]{4,}", content_str, re.IGNORECASE)
-        if id_match:
-            # If all the four letters are the same, it must be an expression rather than a contact.
-            if not re.search(r"([a-z])(\1{3,})", content_str, re.IGNORECASE):
-                return id_match.group()
+def fetch_reply_range(thread_url: str, first: int, last: int):
+    # Run on the workers: [Reply, ...] of the range, None to load it on the browser instead.
+    scan_rate_limiter.wait()
+    with metrics.timed('fscr_page_load_seconds', page='range', mode='prefetch'):
+        page_source = fetch_page_source(get_range_url(thread_url, first, last), get_ready_class_name(False))
+    if page_source is None:
+        return None
+    return thread_page.parse_thread_page(page_source).replies
 
 
-def scan_head(replies_soup, thread_id, thread_url):
+def catch_up_replies(page: thread_page.ThreadPage, thread_id: int, thread_url: str, last_reply_count: int,
+                     first_visible_no: int):
+    global catch_up_page_budget
+    missed_ranges = get_missed_ranges(last_reply_count, first_visible_no)
+    if not missed_ranges:
+        return
+    if not Constants.CATCH_UP_URL_TEMPLATE or last_reply_count == 0:
+        range_count = 0  # Not stored yet: the history of a new thread is not worth the budget.
+    else:
+        # The oldest first, whose links expire first
+        range_count = min(len(missed_ranges), catch_up_page_budget)
+    caught_up_ranges = missed_ranges[:range_count]
+    catch_up_page_budget -= range_count
+    log_skipped_replies(sum(last - first + 1 for first, last in missed_ranges[range_count:]), thread_url)
+    if not caught_up_ranges:
+        return
+    log('\nCatching up #%d-#%d on %s' % (caught_up_ranges[0][0], caught_up_ranges[-1][1], thread_url), has_tst=True)
+
+    # Fetch the ranges at once on the workers, but scan them here in order.
+    fetched_ranges = [scan_executor.submit(fetch_reply_range, thread_url, first, last)
+                      if Constants.FETCH_MODE == 'http' else None
+                      for first, last in caught_up_ranges]
+    for (first, last), fetched_range in zip(caught_up_ranges, fetched_ranges):
+        replies = fetched_range.result() if fetched_range else None
+        if replies is None:
+            range_url = get_range_url(thread_url, first, last)
+            with metrics.timed('fscr_page_load_seconds', page='range', mode=Constants.FETCH_MODE):
+                loaded_page = load_page(range_url, get_ready_class_name(False))
+            if loaded_page is None or not loaded_page[1]:
+                log('Error: Cannot catch up #%d-#%d. (%s)' % (first, last, range_url))
+                log_skipped_replies(last - first + 1, thread_url)
+                continue
+            replies = thread_page.parse_thread_page(loaded_page[0]).replies
+        # Only the range: the page might show the latest ones as well.
+        replies = [reply for reply in replies if reply.no is not None and first <= reply.no <= last]
+        # Deleted, or the template not giving the range at all
+        log_skipped_replies(last - first + 1 - len(replies), thread_url)
+        metrics.inc('fscr_replies_scanned_total', len(replies))
+        metrics.inc('fscr_replies_caught_up_total', len(replies))
+        for reply in replies:
+            scan_content(page, reply, thread_id, thread_url)
+
+
+def log_skipped_replies(skipped_count: int, thread_url: str):
+    if skipped_count > 0:
+        log('\nSkipping %d unread replies on %s' % (skipped_count, thread_url), has_tst=True)
+        metrics.inc('fscr_replies_skipped_total', skipped_count)
+
+
+def scan_head(page: thread_page.ThreadPage, thread_id, thread_url):
     global prev_pause, prev_prev_pause
-    head = replies_soup.select_one('div.thread-first-reply')
-    links_in_head = head.select('a.link')
-    spec_present = has_specs(head)
-    contact_str = has_contacts(head)
+    head = page.head
+    if head is None:
+        log('Error: Cannot locate the head reply. (%s)' % thread_url)
+        return
+    links_in_head = head.links
+    analysis = reply_content_analyzer.analyze(head)
 
-    report = compose_reply_report(replies_soup, thread_url, head, 1)
-    if spec_present:
+    report = compose_reply_report(page, thread_url, head, analysis)
+    if analysis.specs:
         report += '\n(Specs present)'
-    if contact_str:
-        report += '\n(Contact present: %s)' % contact_str
+    if analysis.contact:
+        report += '\n(Contact present: %s)' % analysis.contact
     # Log every reply.
     log(report, Constants.REPLY_LOG_FILE, has_tst=True)
 
-    if links_in_head or spec_present or contact_str:  # Link(s) present in the head
+    if links_in_head or analysis.specs or analysis.contact:  # Link(s) present in the head
         # Log a meaningful reply.
         log(report, has_print=False)
         # Check if the reply contains ignored patterns.
-        ignored_pattern = has_ignored_content(head)
-        if ignored_pattern:
-            log('(Skipping "%s")' % ignored_pattern)
+        if analysis.ignored_pattern:
+            log('(Skipping "%s")' % analysis.ignored_pattern)
         else:
-            for link in links_in_head:
-                source_url = link['href']
-                downloader.download(source_url, thread_id, 1, prev_pause, prev_prev_pause)
+            for source_url in links_in_head:
+                download_pipeline.submit(source_url, thread_id, 1, prev_pause, prev_prev_pause)
 
 
-def scan_content(replies_soup, reply: bs4.element.Tag, thread_id, thread_url):
+def scan_content(page: thread_page.ThreadPage, reply: thread_page.Reply, thread_id, thread_url):
     log_file_name = 'exception-reply.pv'
 
     try:
         global prev_pause, prev_prev_pause
-        links_in_reply = reply.select('div.th-contents > a.link')
-        spec_present = has_specs(reply)
-        contact_str = has_contacts(reply)
+        links_in_reply = reply.links
+        analysis = reply_content_analyzer.analyze(reply)
 
         # Retrieve the reply information.
-        reply_no_tag = reply.select_one('div.reply-info > span.reply-offset')
-        if reply_no_tag:
-            reply_no_str = reply_no_tag.text
-            reply_no = int(reply_no_str.strip().replace('#', ''))
-            report = compose_reply_report(replies_soup, thread_url, reply, reply_no)
-            if spec_present:
+        if reply.no is not None:
+            reply_no = reply.no
+            report = compose_reply_report(page, thread_url, reply, analysis)
+            if analysis.specs:
                 report += '\n(Specs present)'
-            if contact_str:
-                report += '\n(Contact present: %s)' % contact_str
+            if analysis.contact:
+                report += '\n(Contact present: %s)' % analysis.contact
             # Log every reply.
             log(report, Constants.REPLY_LOG_FILE, has_tst=True)
 
-            if links_in_reply or spec_present or contact_str:
+            if links_in_reply or analysis.specs or analysis.contact:
                 # Log a meaningful reply.
                 log(report, has_print=False)
 
                 # Check if the reply contains ignored patterns.
-                ignored_pattern = has_ignored_content(reply)
-                if ignored_pattern:
-                    log('(Skipping "%s")' % ignored_pattern)
+                if analysis.ignored_pattern:
+                    log('(Skipping "%s")' % analysis.ignored_pattern)
                 else:
-                    for link in links_in_reply:
-                        source_url = link['href']
-                        downloader.download(source_url, thread_id, int(reply_no), prev_pause, prev_prev_pause)
+                    for source_url in links_in_reply:
+                        download_pipeline.submit(source_url, thread_id, reply_no, prev_pause, prev_prev_pause)
         else:
             log('Warning: Unusual reply')
-            log('\n\n[Reply source]\n' + reply.prettify(), file_name=log_file_name)
+            log('\n\n[Reply source]\n' + reply.tag.prettify(), file_name=log_file_name)
 
     except Exception as reply_exception:
         log('Error: Reply scanning failed on %s.' % thread_url, has_tst=True)
         log('Exception: %s\n[Traceback]\n%s' % (reply_exception, traceback.format_exc()), file_name=log_file_name)
-        log('\n\n[Reply source]\n' + reply.prettify(), file_name=log_file_name)
-
+        log('\n\n[Reply source]\n' + reply.tag.prettify(), file_name=log_file_name)
 
-def has_ignored_content(reply):
-    for content in reply.select_one('div.th-contents').contents:
-        if isinstance(content, bs4.element.Tag):  # The content has a substructure.
-            continue
-        else:  # A simple text element
-            for pattern in Constants.IGNORED_REPLY_PATTERNS:
-                if pattern in content:
-                    return pattern
-    else:
-        return None
 
-
-def compose_reply_report(soup, thread_url, reply, reply_no) -> str:
+def compose_reply_report(page: thread_page.ThreadPage, thread_url, reply: thread_page.Reply,
+                         analysis: reply_analyzer.ReplyAnalysis) -> str:
     double_line = '================'
     dashed_line = '----------------'
-    thread_title = soup.select_one('div.thread-info > h3.title').next_element
-    user_id_tag = reply.select_one('span.user-id')
-    user_name_tag = reply.select_one('span.name')
+    thread_title = page.title
     both_filled = False
 
-    if user_id_tag:
-        user_id = user_id_tag.text
-        if user_name_tag:
+    if reply.user_id is not None:
+        user_id = reply.user_id
+        if reply.user_name is not None:
             both_filled = True
-    elif user_name_tag:
-        user_id = user_name_tag.text
+    elif reply.user_name is not None:
+        user_id = reply.user_name
     else:
         user_id = ''
         log('Error: Unknown user_id structure.(%s)' % thread_url)
-        log('\n\n[Reply source]\n' + reply.prettify(),
+        log('\n\n[Reply source]\n' + reply.tag.prettify(),
             file_name='error-reply-user-id.pv')
-    header = '\n' + double_line + '\n' + '<%s>  #%d  %s  %s' % (thread_title, reply_no, user_id, thread_url)
+    header = '\n' + double_line + '\n' + '<%s>  #%d  %s  %s' % (thread_title, reply.no, user_id, thread_url)
     if both_filled:
-        header += '  %s <- Name specified' % user_name_tag.text
-    report = header + '\n' + __format_reply_content(reply) + '\n' + dashed_line
+        header += '  %s <- Name specified' % reply.user_name
+    report = header + '\n' + analysis.message + '\n' + dashed_line
     return report
 
 
-def __format_reply_content(reply):
-    message = ""
-    for content in reply.select_one('div.th-contents').contents:
-        if isinstance(content, bs4.element.Tag):  # The content has a substructure.
-            if content.has_attr('href'):
-                message += content['href'].strip() + " "
-            elif 'class' in content.attrs and content.attrs['class'][0] == 'anchor':
-                message += content.string.strip() + " "
-            elif content == '<br/>' or '<br>':
-                message += '\n'
-            else:
-                message += 'Error: Unknown tag.\n%s\n' % content
-        else:  # A simple text element
-            message += str(content).strip()
-    return message
-
-
 def fluctuate(value):
     # Large values: The random multiplier dominant
     # Small values: The random increment dominant
@@ -330,68 +526,142 @@ def get_absolute_pause(new_reply_count: int):
 # Get how many replies have been uploaded since the last check.
 # If new replies exist, scan the thread.
 def scan_threads(soup) -> int:
-    global thread_db
+    global thread_db, catch_up_page_budget
+    # Spent by this cycle and the scheduled checks in the pause after it
+    catch_up_page_budget = Constants.MAX_CATCH_UP_PAGES_PER_CYCLE
     sum_reply_count_to_scan = 0
-    for thread in soup.select('a.thread-list-item'):
-        thread_id = int(str(thread['href']).split('/')[-1])
-        thread_url = common.Constants.ROOT_DOMAIN + common.Constants.CAUTION_PATH + '/' + str(thread_id)
-        thread_title = thread.select_one('span.title').string
-
-        # The count value is an estimate at this stage.
-        # Difference by 1~2 might occur due to the newly posted replies while scanning.
-        reply_count_str = thread.select_one('span.count').string
-        reply_count_match = re.search("[1-9][0-9]{0,2}", reply_count_str)
-        if reply_count_match:
-            reply_count = int(reply_count_match.group())
-        else:
-            # Cannot retrieve the reply count. Assume the largest number.
-            reply_count = Constants.MAX_REPLIES_POSSIBLE
-
-        # Check if the count has been increased.
-        # If so, scan to check if there are links.
-        last_reply_count = thread_db.get_reply_count(thread_id)
-        new_count = reply_count - last_reply_count
-        if new_count > 0:  # It has changed since the last scan.
-            # Report irregular value for the reply count.
-            if not reply_count_match:
-                if '완결' in reply_count_str:
-                    log('\n<%s> reached the limit.(%s)' % (thread_title, thread_url), has_tst=True)
-                if '닫힘' in reply_count_str:
-                    log('\n<%s> has been blocked.(%s)' % (thread_title, thread_url,), has_tst=True)
-
-            # Accumulate the counts to estimate a proper pause at this stage.
-            sum_reply_count_to_scan += new_count
-            # Filter by titles.
-            for pattern in Constants.IGNORED_TITLE_PATTERNS:
-                if pattern in thread_title:
-                    log('\n<%s> ignored.(%s)' % (thread_title, thread_url), Constants.REPLY_LOG_FILE, True)
-                    # Update DB without actually scanning replies.
-                    # For the non-filtered threads, the reply count will be updated just before scanning.
-                    thread_db.update_thread(thread_id, reply_count)
-                    break
-            else:  # No pattern matched. Scan replies of the thread.
-                try:
-                    if reply_count_match and new_count >= Constants.MAX_REPLIES_VISIBLE:
-                        log('\nSkipping %d unread replies on %s' %
-                            (new_count - Constants.MAX_REPLIES_VISIBLE, thread_url), has_tst=True)
+    threads = soup.select('a.thread-list-item')
+    thread_ids = [int(str(thread['href']).split('/')[-1]) for thread in threads]
+    # Look up the stored counts of the whole page at once.
+    last_reply_counts = thread_db.get_reply_counts(thread_ids)
+    # The (id, count) pairs to store at the end of the cycle, all at once.
+    thread_updates = []
+    # The threads to scan: (thread_id, last_reply_count, head_only, is_reply_count_readable)
+    scan_targets = []
+    try:
+        for thread, thread_id in zip(threads, thread_ids):
+            sum_reply_count_to_scan += check_list_item(thread, thread_id, last_reply_counts[thread_id],
+                                                       thread_updates, scan_targets)
+
+        # Fetch and parse the pages on the workers, but process them here one by one in the list order.
+        prefetched_pages = {}
+        if Constants.FETCH_MODE == 'http' and Constants.SCAN_CONCURRENCY > 1 and len(scan_targets) > 1:
+            for thread_id, _, head_only, _ in scan_targets:
+                prefetched_pages[thread_id] = scan_executor.submit(prefetch_thread, thread_id, head_only)
+        for thread_id, last_reply_count, head_only, is_reply_count_readable in scan_targets:
+            try:
+                prefetched_page = prefetched_pages[thread_id].result() if thread_id in prefetched_pages else None
+                with metrics.timed('fscr_phase_seconds', phase='scan-thread'):
                     scan_thread(thread_id, last_reply_count,
-                                head_only=reply_count == 1,
-                                is_reply_count_readable=reply_count_match is not None)
-                except Exception as thread_exception:
-                    log_file_name = 'exception-thread.pv'
-                    exception_last_line = str(thread_exception).splitlines()[-1]
-                    log('Error: Thread scanning failed on %i(%s).' % (thread_id, exception_last_line), has_tst=True)
-                    log('Exception: %s\n[Traceback]\n%s' % (thread_exception, traceback.format_exc()),
-                        file_name=log_file_name)
-                    log_page_source(file_name=log_file_name)
+                                head_only=head_only,
+                                is_reply_count_readable=is_reply_count_readable,
+                                thread_updates=thread_updates,
+                                prefetched_page=prefetched_page)
+            except Exception as thread_exception:
+                log_thread_exception(thread_id, thread_exception)
+    finally:
+        thread_db.update_threads(thread_updates)
     return sum_reply_count_to_scan
 
 
+def log_thread_exception(thread_id: int, thread_exception: Exception):
+    log_file_name = 'exception-thread.pv'
+    exception_last_line = str(thread_exception).splitlines()[-1]
+    log('Error: Thread scanning failed on %i(%s).' % (thread_id, exception_last_line), has_tst=True)
+    log('Exception: %s\n[Traceback]\n%s' % (thread_exception, traceback.format_exc()),
+        file_name=log_file_name)
+    log_page_source(file_name=log_file_name)
+    common.flush_logs()
+
+
+# Spend the pause until the next list scan on the hot threads due for a check of their own.
+def check_scheduled_threads(pause_sec: float):
+    deadline = time.monotonic() + pause_sec
+    check_count = 0
+    while True:
+        now = time.monotonic()
+        next_check_time = thread_scheduler.get_next_check_time() \
+            if Constants.SCHEDULED_CHECKS_ENABLED and check_count < Constants.MAX_SCHEDULED_CHECKS_PER_PAUSE else None
+        if next_check_time is None or next_check_time >= deadline:
+            time.sleep(max(deadline - now, 0))
+            return
+        if next_check_time > now:
+            time.sleep(next_check_time - now)
+            continue
+        due = thread_scheduler.pop_due()
+        if due is not None:
+            check_count += 1
+            check_scheduled_thread(due[0])
+
+
+def check_scheduled_thread(thread_id: int):
+    last_reply_count = thread_db.get_reply_counts([thread_id])[thread_id]
+    thread_updates = []
+    scan_rate_limiter.wait()
+    try:
+        with metrics.timed('fscr_phase_seconds', phase='scheduled-check'):
+            scan_thread(thread_id, last_reply_count, head_only=False, is_reply_count_readable=True,
+                        thread_updates=thread_updates)
+    except Exception as thread_exception:
+        log_thread_exception(thread_id, thread_exception)
+    finally:
+        thread_db.update_threads(thread_updates)
+    for _, reply_count in thread_updates:
+        if reply_count >= Constants.MAX_REPLIES_POSSIBLE:
+            thread_scheduler.forget(thread_id)
+        else:
+            thread_scheduler.observe(thread_id, reply_count)
+        metrics.inc('fscr_scheduled_checks_total', outcome='new' if reply_count > last_reply_count else 'none')
+
+
+# Check a single item of the thread list and add the thread to scan_targets if it has new replies.
+# Returns the number of the new replies, which the caller accumulates to estimate a proper pause.
+def check_list_item(thread, thread_id: int, last_reply_count: int, thread_updates: list, scan_targets: list) -> int:
+    thread_url = common.Constants.ROOT_DOMAIN + common.Constants.CAUTION_PATH + '/' + str(thread_id)
+    thread_title = thread.select_one('span.title').string
+
+    # The count value is an estimate at this stage.
+    # Difference by 1~2 might occur due to the newly posted replies while scanning.
+    reply_count_str = thread.select_one('span.count').string
+    reply_count_match = re.search("[1-9][0-9]{0,2}", reply_count_str)
+    if reply_count_match:
+        reply_count = int(reply_count_match.group())
+    else:
+        # Cannot retrieve the reply count. Assume the largest number.
+        reply_count = Constants.MAX_REPLIES_POSSIBLE
+
+    # Check if the count has been increased.
+    # If so, scan to check if there are links.
+    new_count = reply_count - last_reply_count
+    if reply_count_match and reply_count < Constants.MAX_REPLIES_POSSIBLE:
+        thread_scheduler.observe(thread_id, reply_count)
+    else:
+        thread_scheduler.forget(thread_id)  # Closed or blocked
+    if new_count > 0:  # It has changed since the last scan.
+        # Report irregular value for the reply count.
+        if not reply_count_match:
+            if '완결' in reply_count_str:
+                log('\n<%s> reached the limit.(%s)' % (thread_title, thread_url), has_tst=True)
+            if '닫힘' in reply_count_str:
+                log('\n<%s> has been blocked.(%s)' % (thread_title, thread_url,), has_tst=True)
+
+        # Filter by titles.
+        if ignored_title_matcher.search(thread_title):
+            log('\n<%s> ignored.(%s)' % (thread_title, thread_url), Constants.REPLY_LOG_FILE, True)
+            # Update DB without actually scanning replies.
+            # For the non-filtered threads, the reply count will be updated just before scanning.
+            thread_updates.append((thread_id, reply_count))
+        else:  # No pattern matched. Scan replies of the thread.
+            scan_targets.append((thread_id, last_reply_count, reply_count == 1, reply_count_match is not None))
+    return max(new_count, 0)
+
+
 def check_privilege(driver: webdriver.Chrome):
     timeout = 20
-    logged_in_class_name = 'user-email'
-    soup = BeautifulSoup(driver.page_source, common.Constants.HTML_PARSER)
-    if soup.select_one('.%s' % logged_in_class_name):
+    logged_in_class_name = Constants.LOGGED_IN_CLASS_NAME
+    with metrics.timed('fscr_parse_seconds', page='privilege'):
+        is_logged_in = has_class(driver.page_source, logged_in_class_name)  # Stops at the first match.
+    if is_logged_in:
         return True
     else:
         log('Login required.', has_tst=True)
@@ -410,29 +680,32 @@ def check_privilege(driver: webdriver.Chrome):
             return False
 
 
+def cool_down(pause_sec: float):
+    # A deliberate wait, timed apart from the work.
+    with metrics.timed('fscr_phase_seconds', phase='cooldown'):
+        time.sleep(pause_sec)
+
+
 def load_thread_list():
     thread_list_url = common.Constants.ROOT_DOMAIN + common.Constants.CAUTION_PATH
     # Get the thread list.
-    browser.get(thread_list_url)
-    is_privileged = check_privilege(browser)
-    if not is_privileged:
-        # Possibly banned for abuse. Cool down.
-        time.sleep(fluctuate(340))
+    with metrics.timed('fscr_page_load_seconds', page='list', mode=Constants.FETCH_MODE):
+        page = load_page(thread_list_url, 'thread-list-item', presence_of_all=True)
+    if page is None:
         return
-    elif browser.current_url != thread_list_url:
-        browser.get(thread_list_url)
+    page_source, is_threads_loaded = page
 
     # Reset the reply count.
     new_reply_count = 0
 
-    is_threads_loaded = wait_and_retry(browser_wait, 'thread-list-item', presence_of_all=True)
     if not is_threads_loaded:
         log('Error: Cannot load thread list after pause of %d".' % prev_pause, has_tst=True)
-        log('Page source\n\n' + browser.page_source, file_name='thread-list-err.pv')
+        log('Page source\n\n' + page_source, file_name='thread-list-err.pv')
         # Cool down and loop again.
-        time.sleep(fluctuate(12))
+        cool_down(fluctuate(12))
         return
-    threads_soup = BeautifulSoup(browser.page_source, common.Constants.HTML_PARSER)
+    with metrics.timed('fscr_parse_seconds', page='list'):
+        threads_soup = BeautifulSoup(page_source, common.Constants.HTML_PARSER)
 
     # Scan thread list and accumulate the number of new replies.
     new_reply_count += scan_threads(threads_soup)
@@ -455,6 +728,21 @@ def impose_pause(new_reply_count: int, elapsed_sec: float):
     return pause, fluctuated_pause
 
 
+def log_cycle_metrics(elapsed_sec: float, new_reply_count: int):
+    # A JSON line of what the cycle has spent where: the counters and the latencies since the last cycle
+    cycle_metrics = {'time': common.get_time_str(), 'elapsed_sec': round(elapsed_sec, 3),
+                     'new_replies': new_reply_count, 'mode': get_scan_mode()}
+    cycle_metrics.update(metrics.registry.take_cycle_summary())
+    log(json.dumps(cycle_metrics, ensure_ascii=False), Constants.METRICS_LOG_FILE, has_print=False)
+
+
+def get_scan_mode() -> str:
+    # To compare the cycle times by the mode
+    if Constants.FETCH_MODE == 'http' and Constants.SCAN_CONCURRENCY > 1:
+        return 'http, %d workers' % Constants.SCAN_CONCURRENCY
+    return '%s, sequential' % Constants.FETCH_MODE
+
+
 def loop_scanning():
     # A random cycle number n
     sufficient_cycle_number = random.randint(
@@ -468,12 +756,21 @@ def loop_scanning():
         while current_cycle_number < sufficient_cycle_number or is_hot:
             # Scan thread list and the new replies.
             scan_start_time = datetime.now()  # Start the timer.
+            cycle_start_time = time.perf_counter()
             sum_new_reply_count = load_thread_list()
             if sum_new_reply_count is None:
+                metrics.inc('fscr_cycles_total', outcome='failed')
                 continue  # Something went wrong. Skip the cycle and retry.
+            # The completed cycles only: a failed one ends in a cooldown, recorded as a phase of its own.
+            metrics.observe('fscr_phase_seconds', time.perf_counter() - cycle_start_time, phase='cycle')
 
             # Impose a proper pause.
             elapsed_for_scanning = common.get_elapsed_sec(scan_start_time)
+            log('%.2f"\t%d new\t%s' % (elapsed_for_scanning, sum_new_reply_count, get_scan_mode()),
+                Constants.CYCLE_LOG_FILE, has_tst=True, has_print=False)
+            metrics.inc('fscr_cycles_total', outcome='scanned')
+            metrics.inc('fscr_new_replies_total', sum_new_reply_count)
+            log_cycle_metrics(elapsed_for_scanning, sum_new_reply_count)
             cycle_pause, fluctuated_cycle_pause = impose_pause(sum_new_reply_count, elapsed_for_scanning)
 
             # Store for the next use.
@@ -484,8 +781,8 @@ def loop_scanning():
             if current_cycle_number >= sufficient_cycle_number and not is_hot:
                 break
 
-            # Sleep to implement random behavior.
-            time.sleep(fluctuated_cycle_pause)
+            # Sleep to implement random behavior, checking the hot threads due meanwhile.
+            check_scheduled_threads(fluctuated_cycle_pause)
 
             # Cycling
             current_cycle_number += 1
@@ -503,14 +800,29 @@ def loop_scanning():
 
 def trim_after_session():
     # Trim the database.
+    delete_start_time = datetime.now()
     deleted_count = thread_db.delete_old_threads()
-    if not deleted_count:
-        log('%d threads have been deleted from database.' % deleted_count, has_tst=True)
-
-    # Trim long log files.
-    common.trim_logs(common.Constants.LOG_PATH + Constants.REPLY_LOG_FILE)
-    common.trim_logs(common.Constants.LOG_PATH + common.Constants.LOG_FILE)
-    common.trim_logs(common.Constants.LOG_PATH + downloader.Constants.DL_LOG_FILE)
+    if deleted_count:
+        log('%d threads have been deleted from database in %.2f".' %
+            (deleted_count, common.get_elapsed_sec(delete_start_time)), has_tst=True)
+    log('Reply count cache: %s' % thread_db.get_cache_stats(), has_tst=True)
+    log('Link resolution cache: %s' % downloader.resolution_cache.get_stats(), has_tst=True)
+    log('Scheduler: %s' % thread_scheduler.get_stats(), has_tst=True)
+    freed_size = downloader.content_store.prune()
+    log('Content store: %s, %.1f MB of unlinked files freed' %
+        (downloader.content_store.get_stats(), freed_size / 1000000), has_tst=True)
+    downloader.resolution_cache.save()
+    downloader.content_store.save()
+    freed_size = downloader.remove_stale_parts()
+    if freed_size:
+        log('Stale partial downloads removed(%.1f MB).' % (freed_size / 1000000), has_tst=True)
+
+    # Rotate long log files.
+    common.rotate_log(common.Constants.LOG_PATH + Constants.REPLY_LOG_FILE)
+    common.rotate_log(common.Constants.LOG_PATH + common.Constants.LOG_FILE)
+    common.rotate_log(common.Constants.LOG_PATH + downloader.Constants.DL_LOG_FILE)
+    common.rotate_log(common.Constants.LOG_PATH + Constants.CYCLE_LOG_FILE)
+    common.rotate_log(common.Constants.LOG_PATH + Constants.METRICS_LOG_FILE)
 
 
 if __name__ == "__main__":
@@ -518,35 +830,76 @@ if __name__ == "__main__":
     prev_pause = 0.0
     prev_prev_pause = 0.0
 
-    # The main loop
-    while True:
-        session_start_time = datetime.now()  # The session timer
+    # The source of the page loaded last, to log on errors
+    last_page_source = ''
 
-        # Connect to the database
-        thread_db = sqlite.ThreadDatabase()
-        log('SQL connection opened.', has_tst=True)
+    # Connect to the database, which is kept across the browser sessions.
+    thread_db = sqlite.open_database()
+    thread_db.create_index()  # For the retention pass
+    cached_count = thread_db.warm_cache()
+    log('SQL connection opened.(%s)' % thread_db.get_connection_stats(), has_tst=True)
+    log('%d threads cached.' % cached_count, has_tst=True)
 
-        # Initiate the browser
-        browser = initiate_browser()
-        browser_wait = WebDriverWait(browser, Constants.HTML_TIMEOUT)
+    # The reply arrival rates of the threads, seeded with the recently updated ones
+    thread_scheduler = scheduler.ThreadScheduler(jitter=fluctuate)
+    seed_since = datetime.now() - timedelta(hours=Constants.SCHEDULER_SEED_HOURS)
+    thread_scheduler.seed(thread_db.get_recent_threads(seed_since))
 
-        # Online process starts.
-        # Login and scan the thread list -> replies on each thread.
-        try:
-            loop_scanning()
-        except selenium.common.exceptions.WebDriverException as e:
-            log('Error: Cannot operate WebDriver(WebDriverException).', has_tst=True)
-            log(traceback.format_exc(), 'exception-webdriver.pv')
-            time.sleep(fluctuate(210))  # Assuming the server is not operating.
-        except Exception as main_loop_exception:
-            log('Error: Cannot retrieve thread list(%s).' % main_loop_exception, has_tst=True)
-            log('Exception:%s\n%s' % (main_loop_exception, traceback.format_exc()), 'main-loop-error.pv')
-        finally:
-            browser.quit()
-            log('Driver session terminated.', has_tst=True)
-            thread_db.close_connection()
-            log('SQL connection closed.', has_tst=True)
-
-        session_pause = Constants.HOT_THRESHOLD_SEC * random.uniform(0.46, 1.2)
-        log('Pause for %.1f min.\t(%s)\n' % (session_pause / 60, common.get_time_str()))
-        time.sleep(session_pause)
+    if Constants.METRICS_PORT:
+        metrics.start_server(Constants.METRICS_PORT)
+        log('Metrics served on port %d.' % Constants.METRICS_PORT, has_tst=True)
+
+    # The workers fetching the changed threads
+    scan_executor = ThreadPoolExecutor(max_workers=Constants.SCAN_CONCURRENCY, thread_name_prefix='scanner')
+    scan_rate_limiter = RateLimiter(Constants.SCAN_MIN_INTERVAL_SEC)
+    catch_up_page_budget = Constants.MAX_CATCH_UP_PAGES_PER_CYCLE
+
+    # The downloads run in the background, across the browser sessions.
+    download_pipeline = downloader.DownloadPipeline()
+    downloader.browser_pool.start()
+
+    # The main loop
+    try:
+        while True:
+            session_start_time = datetime.now()  # The session timer
+
+            # Check the database connection, which might have timed out during the pause.
+            if not thread_db.check_connection():
+                log('SQL connection reopened.(%s)' % thread_db.get_connection_stats(), has_tst=True)
+
+            # Initiate the browser
+            browser = initiate_browser()
+            browser_wait = WebDriverWait(browser, Constants.HTML_TIMEOUT)
+            set_page_session(None)  # Exported from the browser once it has logged in.
+
+            # Online process starts.
+            # Login and scan the thread list -> replies on each thread.
+            try:
+                loop_scanning()
+            except selenium.common.exceptions.WebDriverException as e:
+                log('Error: Cannot operate WebDriver(WebDriverException).', has_tst=True)
+                log(traceback.format_exc(), 'exception-webdriver.pv')
+                common.flush_logs()
+                time.sleep(fluctuate(210))  # Assuming the server is not operating.
+            except Exception as main_loop_exception:
+                log('Error: Cannot retrieve thread list(%s).' % main_loop_exception, has_tst=True)
+                log('Exception:%s\n%s' % (main_loop_exception, traceback.format_exc()), 'main-loop-error.pv')
+                common.flush_logs()
+            finally:
+                browser.quit()
+                log('Driver session terminated.', has_tst=True)
+
+            session_pause = Constants.HOT_THRESHOLD_SEC * random.uniform(0.46, 1.2)
+            log('Pause for %.1f min.\t(%s)\n' % (session_pause / 60, common.get_time_str()))
+            common.flush_logs()
+            time.sleep(session_pause)
+    finally:
+        # Let the fetches in flight finish, dropping the queued ones, before the database and the logs close.
+        scan_executor.shutdown(wait=True, cancel_futures=True)
+        download_pipeline.close()
+        downloader.browser_pool.close()
+        downloader.resolution_cache.save()
+        downloader.content_store.save()
+        thread_db.close_connection()
+        log('SQL connection closed.(%s)' % thread_db.get_connection_stats(), has_tst=True)
+        common.log_writer.close()
@@ -0,0 +1,148 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Constants:
+    # The upper bounds of the latency buckets in seconds, +Inf implied
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    SERVER_HOST = '127.0.0.1'
+
+
+def format_labels(labels: dict) -> str:
+    # {key="value",...} in the Prometheus syntax
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in sorted(labels.items()))
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)  # Not cumulative: rendered cumulatively
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Registry:
+    # Counters and histograms by (name, labels), shared by the scanner, the workers and the download threads.
+    def __init__(self, buckets: tuple = Constants.LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels as a tuple): value
+        self.histograms = {}  # (name, labels as a tuple): Histogram
+        self.last_counters = {}  # As of the last take_cycle_summary()
+        self.last_histograms = {}  # (name, labels as a tuple): (count, sum) as of the last take_cycle_summary()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name: str, **labels):
+        # Observe the seconds the block takes, also when it raises.
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def render(self) -> str:
+        # The Prometheus text exposition format
+        lines = []
+        with self.lock:
+            declared_names = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in declared_names:
+                    lines.append('# TYPE %s counter' % name)
+                    declared_names.add(name)
+                lines.append('%s%s %s' % (name, format_labels(dict(labels)), repr(float(value))))
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                if name not in declared_names:
+                    lines.append('# TYPE %s histogram' % name)
+                    declared_names.add(name)
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(dict(labels, le=repr(upper_bound))),
+                                                     cumulative_count))
+                lines.append('%s_bucket%s %d' % (name, format_labels(dict(labels, le='+Inf')), histogram.count))
+                lines.append('%s_sum%s %s' % (name, format_labels(dict(labels)), repr(histogram.sum)))
+                lines.append('%s_count%s %d' % (name, format_labels(dict(labels)), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def take_cycle_summary(self) -> dict:
+        # What has changed since the last call: {'name{labels}': delta} of the counters,
+        # {'name{labels}': {'count': delta, 'sec': delta}} of the histograms
+        summary = {'counters': {}, 'histograms': {}}
+        with self.lock:
+            for key, value in self.counters.items():
+                delta = value - self.last_counters.get(key, 0)
+                if delta:
+                    summary['counters'][key[0] + format_labels(dict(key[1]))] = delta
+                self.last_counters[key] = value
+            for key, histogram in self.histograms.items():
+                last_count, last_sum = self.last_histograms.get(key, (0, 0.0))
+                if histogram.count != last_count:
+                    summary['histograms'][key[0] + format_labels(dict(key[1]))] = \
+                        {'count': histogram.count - last_count, 'sec': round(histogram.sum - last_sum, 4)}
+                self.last_histograms[key] = (histogram.count, histogram.sum)
+        return summary
+
+
+registry = Registry()
+
+
+def inc(name: str, value: float = 1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    registry.observe(name, value, **labels)
+
+
+def timed(name: str, **labels):
+    return registry.timed(name, **labels)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scraped every few seconds: not worth logging.
+
+
+def start_server(port: int, host: str = Constants.SERVER_HOST) -> ThreadingHTTPServer:
+    # Serve /metrics on a daemon thread.
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
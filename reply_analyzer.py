@@ -0,0 +1,140 @@
+import re
+from collections import deque, namedtuple
+
+import bs4
+
+import thread_page
+
+
+class Constants:
+    # Specs: the first rule alone, the second without a word of [a-k], or two or more of the column rules
+    SPECS_PATTERN = re.compile("(^|[^0-9])[6-9][0|5].{0,8}[a-k]", re.IGNORECASE)
+    SPECS_SHORT_PATTERN = re.compile("[1-9][0-9].{0,4}[a-k]", re.IGNORECASE)
+    SPECS_WORD_PATTERN = re.compile("[a-k][a-z]", re.IGNORECASE)
+    SPECS_COLUMN_PATTERNS = (re.compile("(^|[^0-9])1[4-7][0-9nox]([^0-9시분초개대번~]|$)", re.IGNORECASE),
+                             re.compile("(^|[^0-9])[1-3][0-9nox]([^0-9시분초개대번~]|$)", re.IGNORECASE),
+                             re.compile("(^|[^0-9])[4-6][0-9nox]([^0-9시분초개대번~]|$)", re.IGNORECASE))
+    SPECS_COLUMN_THRESHOLD = 2
+
+    CONTACT_KEYWORD_PATTERN = re.compile("라인|아이디|ID|텔레", re.IGNORECASE)
+    CONTACT_ID_PATTERN = re.compile("[a-z][0-9a-z]{4,}", re.IGNORECASE)
+    # If all the four letters are the same, it must be an expression rather than a contact.
+    REPEATED_LETTER_PATTERN = re.compile(r"([a-z])(\1{3,})", re.IGNORECASE)
+
+
+# specs: bool, contact: the id found or None, ignored_pattern: the first matching pattern or None,
+# message: the formatted content to report
+ReplyAnalysis = namedtuple('ReplyAnalysis', ['specs', 'contact', 'ignored_pattern', 'message'])
+
+
+class PatternMatcher:
+    # Aho-Corasick automaton of plain substrings: finds any of the patterns in one pass over the text.
+    def __init__(self, patterns):
+        # Empty lines of the pattern files are not patterns.
+        self.patterns = tuple(pattern for pattern in patterns if pattern)
+        self.__goto = [{}]  # state -> {character: next state}
+        self.__fail = [0]
+        self.__output = [None]  # state -> the smallest index of the patterns ending here(directly or via fail links)
+        for index, pattern in enumerate(self.patterns):
+            self.__add(pattern, index)
+        self.__link()
+
+    def __add(self, pattern: str, index: int):
+        state = 0
+        for character in pattern:
+            next_state = self.__goto[state].get(character)
+            if next_state is None:
+                next_state = len(self.__goto)
+                self.__goto.append({})
+                self.__fail.append(0)
+                self.__output.append(None)
+                self.__goto[state][character] = next_state
+            state = next_state
+        if self.__output[state] is None:
+            self.__output[state] = index
+
+    def __link(self):
+        # Breadth-first, so that the fail target of a state is complete before the state.
+        queue = deque(self.__goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.__goto[state].items():
+                queue.append(next_state)
+                fail = self.__fail[state]
+                while fail and character not in self.__goto[fail]:
+                    fail = self.__fail[fail]
+                # The children of the root fail back to the root.
+                self.__fail[next_state] = self.__goto[fail].get(character, 0) if state else 0
+                inherited = self.__output[self.__fail[next_state]]
+                if inherited is not None and (self.__output[next_state] is None
+                                              or inherited < self.__output[next_state]):
+                    self.__output[next_state] = inherited
+
+    def search(self, text: str):
+        # The earliest listed pattern found in the text, None if none is.
+        if not self.patterns:
+            return None
+        found = None
+        state = 0
+        for character in text:
+            while state and character not in self.__goto[state]:
+                state = self.__fail[state]
+            state = self.__goto[state].get(character, 0)
+            index = self.__output[state]
+            if index is not None and (found is None or index < found):
+                found = index
+                if found == 0:
+                    break
+        return self.patterns[found] if found is not None else None
+
+
+class ReplyAnalyzer:
+    def __init__(self, ignored_patterns):
+        self.ignored_matcher = PatternMatcher(ignored_patterns)
+
+    def analyze(self, reply: thread_page.Reply) -> ReplyAnalysis:
+        # Walk the contents once: the plain text for the rules and the message for the report.
+        text_list = []
+        message = ''
+        contents = reply.body.contents if reply.body is not None else []
+        for content in contents:
+            if isinstance(content, bs4.element.Tag):  # The content has a substructure.
+                if content.has_attr('href'):
+                    message += content['href'].strip() + " "
+                elif 'class' in content.attrs and content.attrs['class'][0] == 'anchor':
+                    message += content.string.strip() + " "
+                elif content == '<br/>' or '<br>':
+                    message += '\n'
+                else:
+                    message += 'Error: Unknown tag.\n%s\n' % content
+            else:  # A simple text element
+                text_list.append(str(content))
+                message += str(content).strip()
+        # A line break never belongs to a pattern, so no pattern matches across the elements.
+        content_str = '\n'.join(text_list) + '\n' if text_list else ''
+        return ReplyAnalysis(self.__has_specs(content_str),
+                             self.__find_contact(content_str),
+                             self.ignored_matcher.search(content_str),
+                             message)
+
+    @staticmethod
+    def __has_specs(content_str: str) -> bool:
+        if Constants.SPECS_PATTERN.search(content_str):
+            return True
+        if Constants.SPECS_SHORT_PATTERN.search(content_str):
+            if not Constants.SPECS_WORD_PATTERN.search(content_str):
+                return True
+        col_pt = 0
+        for pattern in Constants.SPECS_COLUMN_PATTERNS:
+            if pattern.search(content_str):
+                col_pt += 1
+        return col_pt >= Constants.SPECS_COLUMN_THRESHOLD
+
+    @staticmethod
+    def __find_contact(content_str: str):
+        if Constants.CONTACT_KEYWORD_PATTERN.search(content_str):
+            id_match = Constants.CONTACT_ID_PATTERN.search(content_str)
+            if id_match:
+                if not Constants.REPEATED_LETTER_PATTERN.search(content_str):
+                    return id_match.group()
+        return None
@@ -0,0 +1,115 @@
+import heapq
+import math
+import threading
+import time
+from datetime import datetime
+
+
+class Constants:
+    # The reply arrival rate of a thread is averaged over about this period.
+    RATE_HALF_LIFE_SEC = 900
+    # A check is scheduled when this many new replies are expected, so that most checks find something.
+    EXPECTED_REPLIES_PER_CHECK = 1.5
+    MIN_INTERVAL_SEC = 45  # The hottest threads are not checked more often than this.
+    # Slower threads are left to the thread list: not worth a page load of their own.
+    MAX_INTERVAL_SEC = 900
+    CLOSED_REPLY_COUNT = 300  # Closed threads get no more replies.
+
+
+class ThreadActivity:
+    def __init__(self, reply_count: int, observed_at: float, rate: float = 0.0):
+        self.reply_count = reply_count
+        self.observed_at = observed_at  # time.monotonic()
+        self.rate = rate  # Replies per second, exponentially weighted
+        self.next_check_at = None  # time.monotonic(), None if not scheduled
+
+
+class ThreadScheduler:
+    # Tracks the reply arrival rate of each thread and when the hot ones are due for a check of their own.
+    # Threads are observed on every list scan and direct check; only the ones expected to get a reply within
+    # MAX_INTERVAL_SEC are queued.
+    def __init__(self, jitter=None):
+        self.jitter = jitter if jitter else (lambda interval_sec: interval_sec)  # e.g. fscr.fluctuate
+        self.activities = {}  # thread_id: ThreadActivity
+        self.due_heap = []  # (next_check_at, thread_id), the stale entries skipped on popping
+        self.lock = threading.Lock()
+
+    def seed(self, recent_threads: list):
+        # [(thread_id, count, last_uploaded_at)] from the database: a thread that has got a reply t seconds ago
+        # is assumed to get one every t seconds.
+        now = time.monotonic()
+        for thread_id, reply_count, last_uploaded_at in recent_threads:
+            if thread_id in self.activities or not isinstance(last_uploaded_at, datetime):
+                continue
+            idle_sec = max((datetime.now() - last_uploaded_at).total_seconds(), Constants.MIN_INTERVAL_SEC)
+            activity = ThreadActivity(reply_count, now, 1 / idle_sec)
+            with self.lock:
+                self.activities[thread_id] = activity
+                self.__schedule(thread_id, activity, now)
+
+    def observe(self, thread_id: int, reply_count: int):
+        # Update the rate with the count seen on the list or on the thread page, and reschedule.
+        now = time.monotonic()
+        with self.lock:
+            activity = self.activities.get(thread_id)
+            if activity is None:
+                # First seen: no rate until the count moves.
+                self.activities[thread_id] = ThreadActivity(reply_count, now)
+                return
+            elapsed_sec = now - activity.observed_at
+            if elapsed_sec <= 0:
+                return
+            new_reply_count = max(reply_count - activity.reply_count, 0)
+            weight = 1 - math.pow(0.5, elapsed_sec / Constants.RATE_HALF_LIFE_SEC)
+            activity.rate += weight * (new_reply_count / elapsed_sec - activity.rate)
+            activity.reply_count = reply_count
+            activity.observed_at = now
+            # Seen just now: due again one interval later, which the list scans keep pushing back on their own.
+            self.__schedule(thread_id, activity, now)
+
+    def forget(self, thread_id: int):
+        with self.lock:
+            self.activities.pop(thread_id, None)  # Its heap entry is skipped as stale.
+
+    def get_next_check_time(self):
+        # time.monotonic() of the earliest check due, None if none is queued
+        with self.lock:
+            self.__drop_stale()
+            return self.due_heap[0][0] if self.due_heap else None
+
+    def pop_due(self):
+        # (thread_id, the last count seen) of the earliest thread due by now, None if none is due
+        now = time.monotonic()
+        with self.lock:
+            self.__drop_stale()
+            if not self.due_heap or self.due_heap[0][0] > now:
+                return None
+            _, thread_id = heapq.heappop(self.due_heap)
+            activity = self.activities[thread_id]
+            activity.next_check_at = None
+            return thread_id, activity.reply_count
+
+    def get_stats(self) -> str:
+        with self.lock:
+            scheduled_count = sum(1 for activity in self.activities.values() if activity.next_check_at is not None)
+            return '%d threads tracked, %d scheduled' % (len(self.activities), scheduled_count)
+
+    def __schedule(self, thread_id: int, activity: ThreadActivity, now: float):
+        activity.next_check_at = None
+        if activity.reply_count >= Constants.CLOSED_REPLY_COUNT or activity.rate <= 0:
+            return
+        interval_sec = Constants.EXPECTED_REPLIES_PER_CHECK / activity.rate
+        if interval_sec > Constants.MAX_INTERVAL_SEC:
+            return  # Backed off to the list scans.
+        interval_sec = self.jitter(max(interval_sec, Constants.MIN_INTERVAL_SEC))
+        activity.next_check_at = now + interval_sec
+        heapq.heappush(self.due_heap, (activity.next_check_at, thread_id))
+
+    def __drop_stale(self):
+        # The entries of the forgotten threads and of the rescheduled ones
+        while self.due_heap:
+            next_check_at, thread_id = self.due_heap[0]
+            activity = self.activities.get(thread_id)
+            if activity is not None and activity.next_check_at == next_check_at:
+                return
+            heapq.heappop(self.due_heap)
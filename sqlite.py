@@ -1,5 +1,14 @@
-import mysql.connector
+import sqlite3
+import time
 import common
+import metrics
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+try:
+    import mysql.connector
+except ImportError:  # Only the SQLite backend is available.
+    mysql = None
 
 
 class Table:
@@ -7,75 +16,378 @@ class Table:
     ID = 'id'
     COUNT = 'count'
     LAST_UPLOADED_AT = 'last_uploaded_at'
+    LAST_UPLOADED_AT_INDEX = 'threads_last_uploaded_at'
+
+
+class Constants:
+    # The storage backend: 'mysql' for the local MySQL server, 'sqlite' for an embedded file
+    BACKEND = 'mysql'
+    SQLITE_PATH = 'threads.db'
+
+    # The in-process cache of the reply counts
+    CACHE_MAX_SIZE = 65536
+
+    # The threads not updated for this period are deleted, from the table and the cache alike.
+    RETENTION_DAYS = 70
+    # The rows deleted per statement, to keep each lock short
+    DELETE_BATCH_SIZE = 1000
+
+    # The connection is health-checked before use if it has been idle longer than this.
+    PING_INTERVAL_SEC = 30
+
+
+def open_database():
+    # The database of the configured backend
+    if Constants.BACKEND == 'sqlite':
+        return SqliteThreadDatabase()
+    return ThreadDatabase()
+
+
+class ConnectionManager:
+    # Opens a connection once and reuses it, reconnecting transparently if the health check fails.
+    def __init__(self, connect, ping, ping_interval_sec: float = Constants.PING_INTERVAL_SEC):
+        self.connect = connect  # () -> connection
+        self.ping = ping  # (connection) -> bool
+        self.ping_interval_sec = ping_interval_sec
+        self.connection = None
+        self.last_used_at = 0.0
+
+        # Stats
+        self.connect_count = 0
+        self.reconnect_count = 0
+        self.last_connect_sec = 0.0
+        self.total_connect_sec = 0.0
+
+    def get(self):
+        now = time.monotonic()
+        if self.connection is None:
+            self.open()
+        elif now - self.last_used_at > self.ping_interval_sec and not self.ping(self.connection):
+            self.reconnect()
+        self.last_used_at = time.monotonic()
+        return self.connection
+
+    def open(self):
+        start_time = time.monotonic()
+        self.connection = self.connect()
+        self.last_connect_sec = time.monotonic() - start_time
+        self.total_connect_sec += self.last_connect_sec
+        self.connect_count += 1
+
+    def reconnect(self):
+        self.close()
+        self.reconnect_count += 1
+        self.open()
+
+    def check(self) -> bool:
+        # Health-check right away, reconnecting on failure. Returns False if it has (re)connected.
+        if self.connection is None:
+            self.open()  # Not a reconnect: never opened yet.
+            self.last_used_at = time.monotonic()
+            return False
+        if self.ping(self.connection):
+            self.last_used_at = time.monotonic()
+            return True
+        self.reconnect()
+        return False
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception as e:
+                print('Error: Cannot close the connection(%s).' % e)
+            self.connection = None
+
+    def get_stats(self) -> str:
+        return '%d connects(%d reconnects), last in %.1f ms, %.1f ms in total' % \
+               (self.connect_count, self.reconnect_count, self.last_connect_sec * 1000, self.total_connect_sec * 1000)
 
 
 class ThreadDatabase:
+    # The parameter marker of the driver
+    PLACEHOLDER = '%s'
+
     def __init__(self):
-        user, pw, db_name = common.build_tuple('DB_INFO.pv')
+        # The connection outlives the browser sessions.
+        self.connection_manager = ConnectionManager(self.connect, self.ping)
 
-        self.database = mysql.connector.connect(
+        # {thread_id: (count, last_uploaded_at)}, the least recently used first
+        self.count_cache = OrderedDict()
+        # True if every row of the table is in the cache: then a cache miss means a new thread.
+        self.is_cache_complete = False
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def connect(self):
+        user, pw, db_name = common.build_tuple('DB_INFO.pv')
+        return mysql.connector.connect(
             host="localhost",
             user=user,
             password=pw,
             database=db_name
         )
 
+    @staticmethod
+    def ping(database) -> bool:
+        try:
+            database.ping(reconnect=False)
+            return True
+        except Exception as e:
+            print('Warning: The database connection is lost(%s).' % e)
+            return False
+
+    @property
+    def database(self):
+        # May reconnect: take it once per method, to execute and commit on the same connection.
+        return self.connection_manager.get()
+
+    def check_connection(self) -> bool:
+        return self.connection_manager.check()
+
+    def get_connection_stats(self) -> str:
+        return self.connection_manager.get_stats()
+
+    def get_upsert_query(self) -> str:
+        # INSERT INTO threads (id, count) VALUES (%s, %s) ON DUPLICATE KEY UPDATE count = VALUES(count)
+        return "INSERT INTO %s (%s, %s) VALUES (%s, %s) " % \
+               (Table.NAME, Table.ID, Table.COUNT, self.PLACEHOLDER, self.PLACEHOLDER) + \
+               "ON DUPLICATE KEY UPDATE %s = VALUES(%s)" % (Table.COUNT, Table.COUNT)
+
+    def get_expiry_threshold(self, days: int) -> str:
+        return "DATE_SUB(NOW(), INTERVAL %d DAY)" % days
+
+    def get_batch_delete_query(self, days: int, batch_size: int) -> str:
+        # DELETE FROM threads WHERE last_uploaded_at < DATE_SUB(NOW(), INTERVAL 70 DAY) LIMIT 1000
+        return "DELETE FROM %s WHERE %s < %s LIMIT %d" % \
+               (Table.NAME, Table.LAST_UPLOADED_AT, self.get_expiry_threshold(days), batch_size)
+
     def create_table(self):
         cursor = self.database.cursor()
         cursor.execute(
             "CREATE TABLE IF NOT EXISTS %s (" % Table.NAME +
             "%s INT UNSIGNED NOT NULL PRIMARY KEY, " % Table.ID +
             "%s INT UNSIGNED NOT NULL, " % Table.COUNT +
-            "%s TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP)" % Table.LAST_UPLOADED_AT
+            "%s TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, " % Table.LAST_UPLOADED_AT +
+            "INDEX %s (%s))" % (Table.LAST_UPLOADED_AT_INDEX, Table.LAST_UPLOADED_AT)
         )
         cursor.close()
 
+    def create_index(self):
+        # Add the index on last_uploaded_at to a table created without it.
+        cursor = self.database.cursor()
+        cursor.execute("SHOW INDEX FROM %s WHERE Column_name = %s" % (Table.NAME, self.PLACEHOLDER),
+                       (Table.LAST_UPLOADED_AT,))
+        if not cursor.fetchall():
+            cursor.execute("CREATE INDEX %s ON %s (%s)" %
+                           (Table.LAST_UPLOADED_AT_INDEX, Table.NAME, Table.LAST_UPLOADED_AT))
+        cursor.close()
+
     def drop_table(self):
         cursor = self.database.cursor()
         cursor.execute("DROP TABLE %s" % Table.NAME)
         cursor.close()
 
     def update_thread(self, thread_id: int, count: int):
-        cursor = self.database.cursor()
-        query = "INSERT INTO %s (%s, %s) VALUES (%s, %s) " % \
-                (Table.NAME, Table.ID, Table.COUNT, str(thread_id), str(count)) + \
-                "ON DUPLICATE KEY UPDATE %s = %s" % (Table.COUNT, str(count))
-        cursor.execute(query)
-        self.database.commit()
-        cursor.close()
+        self.update_threads([(thread_id, count)])
 
-    def delete_old_threads(self) -> int:
-        cursor = self.database.cursor()
-        select_query = "SELECT %s FROM %s WHERE %s < DATE_SUB(NOW(), INTERVAL 70 DAY)" % \
-                       (Table.ID, Table.NAME, Table.LAST_UPLOADED_AT)
-        cursor.execute(select_query)
-        counts = len(cursor.fetchall())
-
-        delete_query = "DELETE FROM %s WHERE %s < DATE_SUB(NOW(), INTERVAL 70 DAY)" % \
-                       (Table.NAME, Table.LAST_UPLOADED_AT)
-        cursor.execute(delete_query)
-        self.database.commit()
+    @metrics.timed('fscr_db_seconds', op='update_threads')
+    def update_threads(self, thread_counts: list):
+        # Upsert every (id, count) pair in a single transaction.
+        if not thread_counts:
+            return
+        database = self.database
+        cursor = database.cursor()
+        cursor.executemany(self.get_upsert_query(),
+                           [(int(thread_id), int(count)) for thread_id, count in thread_counts])
+        database.commit()
         cursor.close()
+        for thread_id, count in thread_counts:
+            self.__cache_count(thread_id, count)
+
+    @metrics.timed('fscr_db_seconds', op='delete_old_threads')
+    def delete_old_threads(self, retention_days: int = None, batch_size: int = None) -> int:
+        # Delete in batches using the index on last_uploaded_at, committing each batch.
+        # Constants.RETENTION_DAYS and Constants.DELETE_BATCH_SIZE by default, as set when called
+        if retention_days is None:
+            retention_days = Constants.RETENTION_DAYS
+        if batch_size is None:
+            batch_size = Constants.DELETE_BATCH_SIZE
+        delete_query = self.get_batch_delete_query(retention_days, batch_size)
+        counts = 0
+        database = self.database
+        while True:
+            cursor = database.cursor()
+            cursor.execute(delete_query)
+            deleted_count = cursor.rowcount
+            database.commit()
+            cursor.close()
+            counts += max(deleted_count, 0)
+            if deleted_count < batch_size:
+                break
+        self.__evict_old_counts(retention_days)
         return counts
 
     def get_reply_count(self, thread_id: int):
+        return self.get_reply_counts([thread_id])[int(thread_id)]
+
+    @metrics.timed('fscr_db_seconds', op='get_reply_counts')
+    def get_reply_counts(self, thread_ids: list) -> dict:
+        # SELECT id, count FROM threads WHERE id IN (123456, 123457, ...);
+        # Returns {thread_id: count}, where the threads not stored yet have the count of 0.
+        # Only the threads missing from the cache are queried.
+        counts = {int(thread_id): 0 for thread_id in thread_ids}
+        uncached_ids = []
+        for thread_id in counts:
+            cached_count = self.__get_cached_count(thread_id)
+            if cached_count is not None:
+                counts[thread_id] = cached_count
+            else:
+                uncached_ids.append(thread_id)
+        if not uncached_ids:
+            return counts
         cursor = self.database.cursor()
-        # SELECT count FROM threads WHERE id=123456;
-        query = "SELECT " + Table.COUNT + \
-                " FROM " + Table.NAME + \
-                " WHERE " + Table.ID + " = " + str(thread_id)
-        cursor.execute(query)
-        result = cursor.fetchall()
-        cursor.close()
-        # Expected: result = [(237,)]
-        if not result:
-            return 0  # result = [] for a new thread_id
-        else:
+        placeholders = ', '.join([self.PLACEHOLDER] * len(uncached_ids))
+        query = "SELECT %s, %s, %s FROM %s WHERE %s IN (%s)" % \
+                (Table.ID, Table.COUNT, Table.LAST_UPLOADED_AT, Table.NAME, Table.ID, placeholders)
+        cursor.execute(query, tuple(uncached_ids))
+        for thread_id, count, last_uploaded_at in cursor.fetchall():
             try:
-                return int(result[0][0])
+                counts[int(thread_id)] = int(count)
+                self.__cache_count(int(thread_id), int(count), last_uploaded_at)
             except Exception as e:
                 print("The count of the thread undefined: " + str(e))
-                return 0
+        cursor.close()
+        return counts
+
+    @metrics.timed('fscr_db_seconds', op='warm_cache')
+    def warm_cache(self):
+        # Load the most recently updated threads into the cache.
+        cursor = self.database.cursor()
+        query = "SELECT %s, %s, %s FROM %s ORDER BY %s DESC LIMIT %d" % \
+                (Table.ID, Table.COUNT, Table.LAST_UPLOADED_AT, Table.NAME,
+                 Table.LAST_UPLOADED_AT, Constants.CACHE_MAX_SIZE + 1)
+        cursor.execute(query)
+        rows = cursor.fetchall()
+        cursor.close()
+
+        self.count_cache.clear()
+        for thread_id, count, last_uploaded_at in reversed(rows[:Constants.CACHE_MAX_SIZE]):
+            self.count_cache[int(thread_id)] = (int(count), last_uploaded_at)
+        # The whole table fits in the cache.
+        self.is_cache_complete = len(rows) <= Constants.CACHE_MAX_SIZE
+        return len(self.count_cache)
+
+    def get_recent_threads(self, since: datetime) -> list:
+        # [(id, count, last_uploaded_at)] of the cached threads updated since then
+        return [(thread_id, count, last_uploaded_at)
+                for thread_id, (count, last_uploaded_at) in self.count_cache.items()
+                if last_uploaded_at is not None and last_uploaded_at >= since]
+
+    def get_cache_stats(self) -> str:
+        lookups = self.cache_hits + self.cache_misses
+        hit_ratio = self.cache_hits / lookups * 100 if lookups else 0
+        return '%d hits, %d misses(%.1f%% hit) on %d cached threads' % \
+               (self.cache_hits, self.cache_misses, hit_ratio, len(self.count_cache))
+
+    def __get_cached_count(self, thread_id: int):
+        cached = self.count_cache.get(thread_id)
+        if cached is None:
+            self.cache_misses += 1
+            if self.is_cache_complete:
+                return 0  # Not stored yet: a new thread.
+            return None  # Unknown: the database should be queried.
+        self.cache_hits += 1
+        self.count_cache.move_to_end(thread_id)
+        return cached[0]
+
+    def __cache_count(self, thread_id: int, count: int, last_uploaded_at: datetime = None):
+        thread_id, count = int(thread_id), int(count)
+        cached = self.count_cache.get(thread_id)
+        if last_uploaded_at is None:
+            # The timestamp is updated only if the count has been changed. (ON UPDATE CURRENT_TIMESTAMP)
+            last_uploaded_at = cached[1] if cached and cached[0] == count else datetime.now()
+        self.count_cache[thread_id] = (count, last_uploaded_at)
+        self.count_cache.move_to_end(thread_id)
+        while len(self.count_cache) > Constants.CACHE_MAX_SIZE:
+            self.count_cache.popitem(last=False)
+            self.is_cache_complete = False  # The evicted threads are only in the database.
+
+    def __evict_old_counts(self, retention_days: int):
+        threshold = datetime.now() - timedelta(days=retention_days)
+        for thread_id in [thread_id for thread_id, (_, last_uploaded_at) in self.count_cache.items()
+                          if last_uploaded_at is None or last_uploaded_at < threshold]:
+            del self.count_cache[thread_id]
 
     def close_connection(self):
-        self.database.close()
+        self.connection_manager.close()
+
+
+class SqliteThreadDatabase(ThreadDatabase):
+    PLACEHOLDER = '?'
+
+    def __init__(self, path: str = None):
+        self.path = path if path else Constants.SQLITE_PATH
+        super().__init__()
+        self.create_table()
+
+    def connect(self):
+        # TIMESTAMP columns are read as datetime.
+        database = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=256)
+        database.execute("PRAGMA journal_mode=WAL")
+        database.execute("PRAGMA synchronous=NORMAL")
+        return database
+
+    @staticmethod
+    def ping(database) -> bool:
+        try:
+            database.execute("SELECT 1").fetchall()
+            return True
+        except Exception as e:
+            print('Warning: The database connection is lost(%s).' % e)
+            return False
+
+    def get_upsert_query(self) -> str:
+        # INSERT INTO threads (id, count) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET count = excluded.count
+        return "INSERT INTO %s (%s, %s) VALUES (?, ?) " % (Table.NAME, Table.ID, Table.COUNT) + \
+               "ON CONFLICT(%s) DO UPDATE SET %s = excluded.%s" % (Table.ID, Table.COUNT, Table.COUNT)
+
+    def get_expiry_threshold(self, days: int) -> str:
+        return "datetime('now', 'localtime', '-%d days')" % days
+
+    def get_batch_delete_query(self, days: int, batch_size: int) -> str:
+        # DELETE ... LIMIT is not available on the default builds of SQLite.
+        return "DELETE FROM %s WHERE %s IN (SELECT %s FROM %s WHERE %s < %s LIMIT %d)" % \
+               (Table.NAME, Table.ID, Table.ID, Table.NAME, Table.LAST_UPLOADED_AT,
+                self.get_expiry_threshold(days), batch_size)
+
+    def create_table(self):
+        # The timestamps are in the local time as in MySQL.
+        database = self.database
+        database.execute(
+            "CREATE TABLE IF NOT EXISTS %s (" % Table.NAME +
+            "%s INTEGER NOT NULL PRIMARY KEY, " % Table.ID +
+            "%s INTEGER NOT NULL, " % Table.COUNT +
+            "%s TIMESTAMP DEFAULT (datetime('now', 'localtime')))" % Table.LAST_UPLOADED_AT
+        )
+        self.create_index()
+        # ON UPDATE CURRENT_TIMESTAMP: touch the row only if the count has been changed.
+        database.execute(
+            "CREATE TRIGGER IF NOT EXISTS %s_on_update " % Table.NAME +
+            "AFTER UPDATE OF %s ON %s " % (Table.COUNT, Table.NAME) +
+            "WHEN NEW.%s != OLD.%s BEGIN " % (Table.COUNT, Table.COUNT) +
+            "UPDATE %s SET %s = datetime('now', 'localtime') WHERE %s = NEW.%s; END" %
+            (Table.NAME, Table.LAST_UPLOADED_AT, Table.ID, Table.ID)
+        )
+        database.commit()
+
+    def create_index(self):
+        self.database.execute(
+            "CREATE INDEX IF NOT EXISTS %s ON %s (%s)" %
+            (Table.LAST_UPLOADED_AT_INDEX, Table.NAME, Table.LAST_UPLOADED_AT)
+        )
+
+    def drop_table(self):
+        database = self.database
+        database.execute("DROP TABLE %s" % Table.NAME)
+        database.commit()
@@ -0,0 +1,408 @@
+# A local stand-in for the board and the image hosts, to run fscr.py and downloader.py against offline.
+# The board is served on the address itself, e.g. ROOT_URL.pv: http://127.0.0.1:8080
+# The hosts(imgdb.in, ibb.co, postimg.cc, tmpstorage.com) are told apart by the Host header or the absolute url of
+# a proxy request: set downloader.Constants.HTTP_PROXY to the same address for the links to reach them.
+# Usage: python standin_server.py [--port 8080] [--latency-ms 80] [--failure-rate 0.02] ... (--help)
+import argparse
+import hashlib
+import html
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class Constants:
+    CAUTION_PATH = '/caution'
+    LOGIN_PATH = '/login'
+    SESSION_COOKIE = 'standin-session'
+    FIRST_THREAD_ID = 200000
+    MAX_REPLIES = 300  # A thread is closed at this count and replaced by a new one.
+    VISIBLE_REPLIES = 24  # The latest replies shown on a thread page
+    FILE_CHUNK_SIZE = 64 * 1024
+
+    # The hosts the reply links point to, in the proportion of the links
+    LINK_HOSTS = ('imgdb.in', 'imgdb.in', 'ibb.co', 'postimg.cc', 'tmpstorage.com')
+    REPLY_TEXTS = ('오늘 날씨 좋네요', 'ㅋㅋㅋㅋ 그러게요', '65 c 정도', '라인 abcde12 로 연락주세요',
+                   '17o 5x 6o', '저번 글 이어서 씁니다', '이거 맞나요?', 'aaaa 진짜요')
+
+
+class Settings:
+    # Filled from the command line
+    latency_ms = 80.0
+    latency_jitter_ms = 40.0  # The mean of the exponential tail on top of latency_ms
+    file_size = 512 * 1024
+    failure_rate = 0.02  # 500s on the pages, cut-off bodies on the files
+    deleted_rate = 0.05  # Deleted or expired hosted files
+    password_rate = 0.2  # Password-protected tmpstorage links
+    password = 'password'
+    thread_count = 50
+    reply_rate = 2.0  # New replies per second across the board
+    link_rate = 0.15  # Replies carrying a link
+    session_ttl_sec = 0.0  # 0 to keep the login forever
+    seed = 0
+
+
+class Board:
+    # The threads and their reply counts, growing with time.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.random = random.Random(Settings.seed)
+        self.next_thread_id = Constants.FIRST_THREAD_ID
+        self.threads = {}  # id: [reply count, last updated at]
+        self.pending_replies = 0.0
+        self.last_advanced_at = time.monotonic()
+        for _ in range(Settings.thread_count):
+            self.__open_thread(self.random.randint(1, Constants.MAX_REPLIES // 2))
+
+    def __open_thread(self, reply_count: int = 1):
+        self.threads[self.next_thread_id] = [reply_count, time.time()]
+        self.next_thread_id += 1
+
+    def advance(self):
+        # Post the replies due since the last call, mostly on the recently active threads.
+        with self.lock:
+            now = time.monotonic()
+            self.pending_replies += (now - self.last_advanced_at) * Settings.reply_rate
+            self.last_advanced_at = now
+            while self.pending_replies >= 1:
+                self.pending_replies -= 1
+                thread_ids = sorted(self.threads, key=lambda i: self.threads[i][1], reverse=True)
+                thread_id = thread_ids[min(int(self.random.expovariate(0.2)), len(thread_ids) - 1)]
+                thread = self.threads[thread_id]
+                thread[0] += 1
+                thread[1] = time.time()
+                if thread[0] >= Constants.MAX_REPLIES:
+                    del self.threads[thread_id]
+                    self.__open_thread()
+
+    def get_threads(self) -> list:
+        # [(id, reply count)], the latest updated first
+        with self.lock:
+            return [(thread_id, self.threads[thread_id][0])
+                    for thread_id in sorted(self.threads, key=lambda i: self.threads[i][1], reverse=True)]
+
+    def get_reply_count(self, thread_id: int):
+        with self.lock:
+            thread = self.threads.get(thread_id)
+            return thread[0] if thread else None
+
+
+class Stats:
+    # Requests served per (host, status), reported periodically
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.sent_bytes = 0
+        self.started_at = time.monotonic()
+
+    def record(self, host: str, status: int, sent_bytes: int):
+        with self.lock:
+            self.counts[(host, status)] += 1
+            self.sent_bytes += sent_bytes
+
+    def report(self) -> str:
+        with self.lock:
+            elapsed_sec = max(time.monotonic() - self.started_at, 0.001)
+            total = sum(self.counts.values())
+            lines = ['%d requests(%.1f/s), %.1f MB(%.2f MB/s) in %.f"' %
+                     (total, total / elapsed_sec, self.sent_bytes / 1000000, self.sent_bytes / 1000000 / elapsed_sec,
+                      elapsed_sec)]
+            for (host, status), count in sorted(self.counts.items()):
+                lines.append('  %-16s %d: %d' % (host, status, count))
+            return '\n'.join(lines)
+
+
+board = None
+stats = Stats()
+sessions = {}  # token: logged in at
+sessions_lock = threading.Lock()
+
+
+def get_outcome_random(path: str) -> random.Random:
+    # The same link always has the same fate.
+    return random.Random(hashlib.md5(('%d %s' % (Settings.seed, path)).encode()).digest())
+
+
+def is_deleted(path: str) -> bool:
+    return get_outcome_random(path).random() < Settings.deleted_rate
+
+
+def get_file_size(path: str) -> int:
+    return max(int(Settings.file_size * get_outcome_random(path).uniform(0.5, 1.5)), 1)
+
+
+def get_thread_url(thread_id: int) -> str:
+    return '%s/%d' % (Constants.CAUTION_PATH, thread_id)
+
+
+# The board pages
+def render_page(body: str, is_logged_in: bool) -> str:
+    header = '<span class="user-email">standin@board.invalid</span>' if is_logged_in else \
+        '<a class="login" href="%s">login</a>' % Constants.LOGIN_PATH
+    return '<html><head><meta charset="utf-8"><title>board</title></head><body><div class="header">%s</div>%s' \
+           '</body></html>' % (header, body)
+
+
+def render_thread_list() -> str:
+    items = []
+    for thread_id, reply_count in board.get_threads():
+        items.append('<a class="thread-list-item" href="%s"><span class="title">thread %d</span>'
+                     '<span class="count">%d</span></a>' % (get_thread_url(thread_id), thread_id, reply_count))
+    return '<div class="thread-list">%s</div>' % ''.join(items)
+
+
+def render_thread(thread_id: int, reply_count: int, reply_range: tuple = None) -> str:
+    # The latest replies, or the (first, last) range of them
+    first, last = reply_range if reply_range else (reply_count - Constants.VISIBLE_REPLIES + 1, reply_count)
+    replies = []
+    for reply_no in range(max(2, first), min(last, reply_count) + 1):
+        replies.append('<div class="thread-reply"><div class="reply-info"><span class="reply-offset">#%d</span>'
+                       '<span class="user-id">user%03d</span></div>%s</div>'
+                       % (reply_no, reply_no % 1000, render_reply_contents(thread_id, reply_no)))
+    return '<div class="thread-info"><h3 class="title">thread %d</h3><span class="reply-count">%d</span></div>' \
+           '<div class="thread-first-reply"><span class="user-id">author</span>%s</div>%s' \
+           % (thread_id, reply_count, render_reply_contents(thread_id, 1), ''.join(replies))
+
+
+def render_reply_contents(thread_id: int, reply_no: int) -> str:
+    reply_random = random.Random(thread_id * 1000 + reply_no)
+    contents = html.escape(reply_random.choice(Constants.REPLY_TEXTS))
+    if reply_random.random() < Settings.link_rate:
+        host = reply_random.choice(Constants.LINK_HOSTS)
+        contents += '<br><a class="link" href="http://%s/%d%03d">link</a>' % (host, thread_id, reply_no)
+    return '<div class="th-contents">%s</div>' % contents
+
+
+def render_login() -> str:
+    # The inputs at the positions check_privilege() looks for
+    return '<div id="app"><div><form method="post" action="%s">' \
+           '<input type="text" name="email"><input type="password" name="password"><input type="submit">' \
+           '</form></div></div>' % Constants.LOGIN_PATH
+
+
+# The hosts
+def render_imgdb(path: str) -> str:
+    if is_deleted(path):
+        return '<html><head><script>location.href="/?err=1";</script></head><body></body></html>'
+    return '<html><head><link rel="image_src" href="http://imgdb.in/files%s.jpg"></head><body></body></html>' % path
+
+
+def render_ibb(path: str) -> str:
+    if is_deleted(path):
+        return '<html><body><div class="page-not-found">Not found</div></body></html>'
+    return '<html><body><div id="image-viewer-container"><img src="http://i.ibb.co%s/image.jpg"></div>' \
+           '</body></html>' % path
+
+
+def render_postimg(path: str) -> str:
+    return '<html><body><a id="download" href="%s/download">Download</a><img id="main-image" ' \
+           'src="http://i.postimg.cc%s/image.jpg"></body></html>' % (path, path)
+
+
+def render_tmpstorage(path: str, is_unlocked: bool) -> str:
+    # The download button at /html/body/div[2]/div/p/a,
+    # the password form submitted with /html/body/div[1]/div/form/p/input
+    if is_deleted(path):
+        return '<html><body><div id="expired"><p class="notice">Expired</p></div></body></html>'
+    if get_outcome_random(path + '#password').random() < Settings.password_rate and not is_unlocked:
+        return '<html><body><div><div><form method="post" action="%s"><input type="password" id="password" ' \
+               'name="password"><p><input type="submit" value="OK"></p></form></div></div></body></html>' % path
+    return '<html><body><div>tmpstorage</div><div><div><p><a href="%s/download">Download</a></p></div></div>' \
+           '</body></html>' % path
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass  # Counted in stats instead.
+
+    def do_HEAD(self):
+        self.__handle(send_body=False)
+
+    def do_GET(self):
+        self.__handle(send_body=True)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode()) if length else {}
+        self.__handle(send_body=True, form=form)
+
+    def __handle(self, send_body: bool, form: dict = None):
+        url = urlsplit(self.path)
+        host = (url.hostname or self.headers.get('Host', '')).split(':')[0].replace('www.', '')
+        path = url.path.rstrip('/') or '/'
+        time.sleep((Settings.latency_ms + random.expovariate(1 / Settings.latency_jitter_ms)
+                    if Settings.latency_jitter_ms else Settings.latency_ms) / 1000)
+        try:
+            if path.endswith('/download') or path.startswith('/files') or host.startswith('i.'):
+                self.__send_file(host, path, send_body)
+            elif host == 'imgdb.in':
+                self.__send_page(host, render_imgdb(path), send_body)
+            elif host == 'ibb.co':
+                self.__send_page(host, render_ibb(path), send_body)
+            elif host == 'postimg.cc':
+                self.__send_page(host, render_postimg(path), send_body)
+            elif host == 'tmpstorage.com':
+                is_unlocked = form is not None and form.get('password', [''])[0] == Settings.password
+                self.__send_page(host, render_tmpstorage(path, is_unlocked), send_body)
+            else:
+                self.__handle_board(path, send_body, form)
+        except (BrokenPipeError, ConnectionResetError):
+            stats.record(host, 499, 0)  # Closed by the client
+
+    def __handle_board(self, path: str, send_body: bool, form: dict):
+        host = 'board'
+        if path == Constants.LOGIN_PATH:
+            if form is not None:  # Any credentials are accepted.
+                token = hashlib.md5(('%f %f' % (time.time(), random.random())).encode()).hexdigest()
+                with sessions_lock:
+                    sessions[token] = time.monotonic()
+                self.__send_redirect(host, Constants.CAUTION_PATH, 'Set-Cookie', '%s=%s; Path=/' %
+                                     (Constants.SESSION_COOKIE, token))
+            else:
+                self.__send_page(host, render_page(render_login(), False), send_body)
+            return
+        if random.random() < Settings.failure_rate:
+            self.__send_page(host, render_page('Internal Server Error', False), send_body, status=500)
+            return
+
+        board.advance()
+        is_logged_in = self.__is_logged_in()
+        if path == Constants.CAUTION_PATH or path == '/':
+            self.__send_page(host, render_page(render_thread_list() if is_logged_in else '', is_logged_in), send_body)
+            return
+        # The latest replies on /caution/<id>, a range of them on /caution/<id>/<first>-<last>
+        thread_match = re.fullmatch(Constants.CAUTION_PATH + r'/(\d+)(?:/(\d+)-(\d+))?', path)
+        reply_count = board.get_reply_count(int(thread_match.group(1))) if thread_match else None
+        if reply_count is None:
+            self.__send_page(host, render_page('Not found', is_logged_in), send_body, status=404)
+        else:
+            reply_range = (int(thread_match.group(2)), int(thread_match.group(3))) if thread_match.group(2) else None
+            body = render_thread(int(thread_match.group(1)), reply_count, reply_range) if is_logged_in else ''
+            self.__send_page(host, render_page(body, is_logged_in), send_body)
+
+    def __is_logged_in(self) -> bool:
+        cookie_match = re.search(Constants.SESSION_COOKIE + r'=([0-9a-f]+)', self.headers.get('Cookie', ''))
+        if not cookie_match:
+            return False
+        with sessions_lock:
+            logged_in_at = sessions.get(cookie_match.group(1))
+        if logged_in_at is None:
+            return False
+        return not Settings.session_ttl_sec or time.monotonic() - logged_in_at < Settings.session_ttl_sec
+
+    def __send_page(self, host: str, page: str, send_body: bool, status: int = 200):
+        body = page.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+        stats.record(host, status, len(body) if send_body else 0)
+
+    def __send_redirect(self, host: str, location: str, header_name: str, header_value: str):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header(header_name, header_value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        stats.record(host, 302, 0)
+
+    def __send_file(self, host: str, path: str, send_body: bool):
+        # An image of a steady size per url, with Range support. Cut off midway at the failure rate.
+        file_size = get_file_size(path)
+        start = 0
+        range_match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if range_match and int(range_match.group(1)) < file_size:
+            start = int(range_match.group(1))
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"%s"' % hashlib.md5(path.encode()).hexdigest())
+        if path.endswith('/download'):
+            self.send_header('Content-Disposition', 'attachment; filename="%s.jpg"' % path.strip('/').split('/')[0])
+        if start:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, file_size - 1, file_size))
+        self.send_header('Content-Length', str(file_size - start))
+        self.end_headers()
+        if not send_body:
+            stats.record(host, 206 if start else 200, 0)
+            return
+
+        cut_off_at = file_size
+        if random.random() < Settings.failure_rate:
+            cut_off_at = random.randint(start, file_size - 1)
+        chunk = b'\xff' * Constants.FILE_CHUNK_SIZE
+        position = start
+        while position < cut_off_at:
+            length = min(Constants.FILE_CHUNK_SIZE, cut_off_at - position)
+            self.wfile.write(chunk[:length])
+            position += length
+        if cut_off_at < file_size:
+            self.close_connection = True
+            stats.record(host, 599, position - start)  # Cut off on purpose
+        else:
+            stats.record(host, 206 if start else 200, position - start)
+
+
+def report_periodically(interval_sec: float):
+    while True:
+        time.sleep(interval_sec)
+        print(stats.report(), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a stand-in board and image hosts on a local port.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency-ms', type=float, default=Settings.latency_ms)
+    parser.add_argument('--latency-jitter-ms', type=float, default=Settings.latency_jitter_ms)
+    parser.add_argument('--file-size', type=int, default=Settings.file_size, help='mean bytes of the images')
+    parser.add_argument('--failure-rate', type=float, default=Settings.failure_rate)
+    parser.add_argument('--deleted-rate', type=float, default=Settings.deleted_rate)
+    parser.add_argument('--password-rate', type=float, default=Settings.password_rate)
+    parser.add_argument('--password', default=Settings.password, help='of the protected tmpstorage links')
+    parser.add_argument('--threads', type=int, default=Settings.thread_count, help='threads on the list')
+    parser.add_argument('--reply-rate', type=float, default=Settings.reply_rate, help='new replies per second')
+    parser.add_argument('--link-rate', type=float, default=Settings.link_rate)
+    parser.add_argument('--session-ttl', type=float, default=Settings.session_ttl_sec, help='0 for no expiry')
+    parser.add_argument('--report-sec', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=Settings.seed)
+    args = parser.parse_args()
+
+    Settings.latency_ms = args.latency_ms
+    Settings.latency_jitter_ms = args.latency_jitter_ms
+    Settings.file_size = args.file_size
+    Settings.failure_rate = args.failure_rate
+    Settings.deleted_rate = args.deleted_rate
+    Settings.password_rate = args.password_rate
+    Settings.password = args.password
+    Settings.thread_count = args.threads
+    Settings.reply_rate = args.reply_rate
+    Settings.link_rate = args.link_rate
+    Settings.session_ttl_sec = args.session_ttl
+    Settings.seed = args.seed
+
+    global board
+    board = Board()
+    server = ThreadingHTTPServer((args.host, args.port), StandinHandler)
+    server.daemon_threads = True
+    threading.Thread(target=report_periodically, args=(args.report_sec,), daemon=True).start()
+    print('Serving on http://%s:%d (ROOT_URL.pv, downloader.Constants.HTTP_PROXY)' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(stats.report())
+
+
+if __name__ == '__main__':
+    main()
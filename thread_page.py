@@ -0,0 +1,66 @@
+import importlib.util
+from collections import namedtuple
+
+from bs4 import BeautifulSoup, SoupStrainer
+import common
+import metrics
+
+
+class Constants:
+    # The fastest BeautifulSoup backend installed
+    PAGE_PARSER = 'lxml' if importlib.util.find_spec('lxml') else common.Constants.HTML_PARSER
+
+    # Only these containers(and their descendants) of a thread page are parsed.
+    PARSED_CLASS_NAMES = ['thread-info', 'reply-count', 'thread-first-reply', 'thread-reply']
+
+
+# The context of a thread page, extracted once per page
+# title: str, reply_count_str: the text of span.reply-count, last_reply_no: the text of the last span.reply-offset,
+# head: Reply of the #1, replies: [Reply, ...] of div.thread-reply
+ThreadPage = namedtuple('ThreadPage', ['title', 'reply_count_str', 'last_reply_no', 'head', 'replies'])
+
+# no: int(None if unreadable), user_id, user_name: str or None,
+# body: div.th-contents, links: [href, ...], tag: the whole reply to log on errors
+Reply = namedtuple('Reply', ['no', 'user_id', 'user_name', 'body', 'links', 'tag'])
+
+__thread_page_strainer = SoupStrainer(class_=Constants.PARSED_CLASS_NAMES)
+
+
+@metrics.timed('fscr_parse_seconds', page='thread')
+def parse_thread_page(page_source: str) -> ThreadPage:
+    soup = BeautifulSoup(page_source, Constants.PAGE_PARSER, parse_only=__thread_page_strainer)
+
+    title_tag = soup.select_one('div.thread-info > h3.title')
+    title = str(title_tag.next_element) if title_tag else ''
+    reply_count_tag = soup.select_one('span.reply-count')
+    reply_count_str = reply_count_tag.text if reply_count_tag else ''
+    reply_offset_tags = soup.select('span.reply-offset')
+    last_reply_no = reply_offset_tags[-1].text.strip().strip('#') if reply_offset_tags else ''
+
+    head_tag = soup.select_one('div.thread-first-reply')
+    head = parse_reply(head_tag, is_head=True) if head_tag else None
+    replies = [parse_reply(reply_tag) for reply_tag in soup.select('div.thread-reply')]
+    return ThreadPage(title, reply_count_str, last_reply_no, head, replies)
+
+
+def parse_reply(reply_tag, is_head: bool = False) -> Reply:
+    if is_head:
+        reply_no = 1
+        links = [link['href'] for link in reply_tag.select('a.link')]
+    else:
+        reply_no = None
+        reply_no_tag = reply_tag.select_one('div.reply-info > span.reply-offset')
+        if reply_no_tag:
+            try:
+                reply_no = int(reply_no_tag.text.strip().replace('#', ''))
+            except ValueError:
+                pass  # An unusual reply, reported by the caller
+        links = [link['href'] for link in reply_tag.select('div.th-contents > a.link')]
+    user_id_tag = reply_tag.select_one('span.user-id')
+    user_name_tag = reply_tag.select_one('span.name')
+    return Reply(reply_no,
+                 user_id_tag.text if user_id_tag else None,
+                 user_name_tag.text if user_name_tag else None,
+                 reply_tag.select_one('div.th-contents'),
+                 links,
+                 reply_tag)